@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+import ollama
+from app.llm_client import _percentile
+
+AUTOTUNE_FILE = os.path.expanduser('~/.lex_summary/autotune.json')
+
+# Filler text for the calibration prompts, the prompt size matters as prompt evaluation
+# competes with generation on the server
+CALIBRATION_TEXT = (
+    "The guest and the host discuss the history of science, the nature of intelligence, "
+    "and how new technologies change the way people live, work and think about the future. "
+)
+
+def _autotune_key(host, model_name, num_ctx):
+    return f"{host}|{model_name}|{num_ctx}"
+
+def _load_autotune_results(file_path=AUTOTUNE_FILE):
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def load_concurrency(host, model_name, num_ctx, file_path=AUTOTUNE_FILE):
+    """The concurrency saved by the autotuner for (host, model, num_ctx), or None."""
+    result = _load_autotune_results(file_path).get(_autotune_key(host, model_name, num_ctx))
+    return result['concurrency'] if result else None
+
+def save_autotune_result(host, model_name, num_ctx, result, file_path=AUTOTUNE_FILE):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    results = _load_autotune_results(file_path)
+    results[_autotune_key(host, model_name, num_ctx)] = result
+    with open(file_path, 'w') as f:
+        json.dump(results, f, indent=4)
+
+
+class ConcurrencyAutotuner:
+    """Finds the number of concurrent generate requests that gives the most aggregate
+    tokens/sec for a host, model and num_ctx.
+
+    Short calibration generations are run at concurrency 1, 2, 4, ... up to max_concurrency.
+    The search stops once throughput stops improving. The lowest concurrency within
+    `tolerance` of the best throughput is chosen, as extra concurrency costs latency and memory.
+    """
+    def __init__(self,
+                 host,
+                 model_name,
+                 num_ctx,
+                 max_concurrency = 8,
+                 prompt_tokens = 2048,
+                 num_predict = 128,
+                 rounds = 2,
+                 tolerance = 0.05):
+        self.host = host
+        self.model_name = model_name
+        self.num_ctx = num_ctx
+        self.max_concurrency = max_concurrency
+        self.num_predict = num_predict
+        self.rounds = rounds
+        self.tolerance = tolerance
+        self.client = ollama.Client(host=host)
+        repeats = max(1, prompt_tokens * 4 // len(CALIBRATION_TEXT))
+        self.prompt = CALIBRATION_TEXT * repeats + "\nSummarize the text above."
+
+    def _generate(self, request_index):
+        start_time = time.perf_counter()
+        # Vary the prompt so the server can not reuse a cached prompt evaluation
+        ollama_response = self.client.generate(
+            model = self.model_name,
+            prompt = f"Request {request_index}.\n{self.prompt}",
+            options = {'temperature': 0.0, 'num_ctx': self.num_ctx, 'num_predict': self.num_predict}
+            )
+        return ollama_response.get('eval_count') or 0, time.perf_counter() - start_time
+
+    def measure(self, concurrency):
+        """Aggregate tokens/sec and latencies at the given concurrency."""
+        request_count = concurrency * self.rounds
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(self._generate, range(request_count)))
+        wall_time = time.perf_counter() - start_time
+
+        latencies = [latency for _, latency in results]
+        return {
+            'concurrency': concurrency,
+            'tokens_per_second': sum(tokens for tokens, _ in results) / wall_time,
+            'p50_latency': _percentile(latencies, 50),
+            'p95_latency': _percentile(latencies, 95),
+        }
+
+    def run(self, save=True):
+        """Run the calibration and return (and by default persist) the best setting."""
+        # Load the model before timing anything
+        self._generate(-1)
+
+        measurements = []
+        concurrency = 1
+        while concurrency <= self.max_concurrency:
+            measurement = self.measure(concurrency)
+            measurements.append(measurement)
+            print(f"Concurrency {concurrency}: {measurement['tokens_per_second']:.1f} tokens/sec, "
+                  f"p50 {measurement['p50_latency']:.1f}s, p95 {measurement['p95_latency']:.1f}s")
+
+            best_so_far = max(m['tokens_per_second'] for m in measurements[:-1]) if len(measurements) > 1 else 0.0
+            if len(measurements) > 1 and measurement['tokens_per_second'] < best_so_far * (1 + self.tolerance):
+                # Throughput has plateaued (the server is saturated or OLLAMA_NUM_PARALLEL is reached)
+                break
+            concurrency *= 2
+
+        best_throughput = max(m['tokens_per_second'] for m in measurements)
+        best = min((m for m in measurements if m['tokens_per_second'] >= best_throughput * (1 - self.tolerance)),
+                   key=lambda m: m['concurrency'])
+        result = dict(best, measured_at=datetime.now().isoformat(timespec='seconds'), measurements=measurements)
+        if save:
+            save_autotune_result(self.host, self.model_name, self.num_ctx, result)
+        return result
+
+
+class AdaptiveConcurrencyController:
+    """Limits the number of concurrent requests and adjusts the limit during a run.
+
+    Completed requests are grouped into windows. After each window the aggregate
+    tokens/sec is compared with the previous window: if it improved the limit keeps
+    moving in the same direction, if it dropped the direction is reversed, otherwise
+    the limit stays. With adaptive=False the limit is fixed.
+    """
+    def __init__(self, concurrency, min_concurrency = 1, max_concurrency = None, adaptive = False, tolerance = 0.1):
+        self.limit = max(1, concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency or max(self.limit, 1) * 2
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+
+        self._condition = threading.Condition()
+        self._active = 0
+        self._direction = 1
+        self._last_throughput = None
+        self._window_start = time.perf_counter()
+        self._window_tokens = 0
+        self._window_count = 0
+
+    @contextmanager
+    def slot(self):
+        """Wait until fewer than limit requests are running."""
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def record(self, eval_tokens):
+        """Record a completed request and adjust the limit at the end of each window."""
+        if not self.adaptive:
+            return
+        with self._condition:
+            self._window_tokens += eval_tokens
+            self._window_count += 1
+            if self._window_count < max(2, self.limit):
+                return
+
+            now = time.perf_counter()
+            throughput = self._window_tokens / max(now - self._window_start, 1e-6)
+            if self._last_throughput is not None:
+                if throughput < self._last_throughput * (1 - self.tolerance):
+                    self._direction = -self._direction
+                    self._change_limit()
+                elif throughput > self._last_throughput * (1 + self.tolerance):
+                    self._change_limit()
+            else:
+                self._change_limit()
+            self._last_throughput = throughput
+            self._window_start = now
+            self._window_tokens = 0
+            self._window_count = 0
+            self._condition.notify_all()
+
+    def _change_limit(self):
+        limit = min(self.max_concurrency, max(self.min_concurrency, self.limit + self._direction))
+        if limit != self.limit:
+            print(f"Adjusting concurrency from {self.limit} to {limit}.")
+            self.limit = limit
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the best number of concurrent requests for an Ollama server")
+    parser.add_argument("model", help="Ollama model name")
+    parser.add_argument("--host", default=os.getenv('OLLAMA_HOST', 'http://localhost:11434'), help="Ollama host")
+    parser.add_argument("--num-ctx", type=int, default=32*1024, help="Context window size used by the pipeline")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="Highest concurrency to try")
+    parser.add_argument("--prompt-tokens", type=int, default=2048, help="Approximate prompt size of each calibration request")
+    parser.add_argument("--num-predict", type=int, default=128, help="Tokens generated by each calibration request")
+
+    args = parser.parse_args()
+    autotuner = ConcurrencyAutotuner(args.host, args.model, args.num_ctx,
+                                     max_concurrency=args.max_concurrency,
+                                     prompt_tokens=args.prompt_tokens,
+                                     num_predict=args.num_predict)
+    result = autotuner.run()
+    print(f"Best concurrency for {args.model} (num_ctx {args.num_ctx}) on {args.host}: {result['concurrency']} "
+          f"at {result['tokens_per_second']:.1f} tokens/sec. Saved to {AUTOTUNE_FILE}.")
@@ -0,0 +1,185 @@
+import threading
+import time
+
+# Used until a tokens/sec measurement for the model is available
+DEFAULT_TOKENS_PER_SECOND = 10.0
+DEFAULT_PROMPT_TOKENS_PER_SECOND = 100.0
+
+# Share of the generated tokens for each stage. The map share is split over the chunks.
+# The final report rewrites the three sections so it gets about as much as they do together.
+STAGE_SHARES = {
+    'map': 0.40,
+    'introduction': 0.07,
+    'main_body': 0.20,
+    'conclusion': 0.07,
+    'final': 0.26,
+}
+
+# Shortest useful response for each stage. These are reserved out of the budget for every call
+# still to come; only a budget smaller than their sum is exceeded
+MIN_NUM_PREDICT = {
+    'map': 128,
+    'introduction': 192,
+    'main_body': 512,
+    'conclusion': 192,
+    'final': 1024,
+}
+
+# Fraction of the remaining time held back for evaluating the prompts of the other calls
+PROMPT_TIME_RESERVE = 0.2
+
+# Prompt token counts are estimated at 4 bytes a token, leave room for the estimate being low
+# as Ollama silently truncates a prompt that does not fit in num_ctx
+PROMPT_TOKEN_MARGIN = 1.25
+
+# A call is always given this many times what evaluating its prompt and generating the
+# shortest response is expected to take, so a run that is already late still finishes
+# (with the shortest responses) rather than failing
+CALL_TIME_MARGIN = 2.0
+
+# Only the final polish is optional; without it the draft report is used
+OPTIONAL_STAGES = ('final',)
+
+
+class GenerationBudgetPlanner:
+    """Assigns num_predict to each LLM call so an episode finishes within
+    a wall-clock deadline and/or a budget of generated tokens.
+
+    The remaining budget is re-planned before every call: MIN_NUM_PREDICT is set aside for
+    each call still to come and the rest is shared between them in proportion to
+    STAGE_SHARES, converting time into tokens with the tokens/sec measured so far for the
+    stage's model. The token budget is a hard limit unless it is smaller than the sum of
+    the minimums, in which case every call gets its minimum. As the deadline gets close the
+    responses get shorter, and the optional final polish pass is skipped when it would
+    not finish in time. The configured num_ctx is left alone since changing it between
+    calls makes Ollama reload the model; num_predict is kept within it.
+    """
+    def __init__(self, throughput, deadline_seconds = None, token_budget = None):
+        if deadline_seconds is None and token_budget is None:
+            raise ValueError("A deadline or a token budget is required")
+        self.throughput = throughput
+        self.deadline_seconds = deadline_seconds
+        self.token_budget = token_budget
+
+        self._lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.tokens_used = 0
+        self.chunk_count = 0
+        self.remaining_calls = {}
+
+    def start(self, chunk_count, start_time = None):
+        """Start the clock (time.perf_counter) for an episode with chunk_count transcript chunks."""
+        with self._lock:
+            self.start_time = start_time if start_time is not None else time.perf_counter()
+            self.tokens_used = 0
+            self.chunk_count = chunk_count
+            self.remaining_calls = {stage: 1 for stage in STAGE_SHARES}
+            self.remaining_calls['map'] = chunk_count
+            minimum_tokens = self._reserved_tokens()
+        if self.token_budget is not None and self.token_budget < minimum_tokens:
+            print(f"The {self.token_budget} token budget is less than the {minimum_tokens} tokens of the shortest "
+                  f"responses for {chunk_count} chunks, the budget will be exceeded")
+
+    def _call_share(self, stage):
+        # Every chunk gets the same part of the map share, however many have been summarized
+        if stage == 'map':
+            return STAGE_SHARES['map'] / max(1, self.chunk_count)
+        return STAGE_SHARES[stage]
+
+    def _remaining_share(self):
+        return sum(self._call_share(stage) * calls for stage, calls in self.remaining_calls.items())
+
+    def _reserved_tokens(self):
+        """The shortest responses of all the calls still to come."""
+        return sum(MIN_NUM_PREDICT[stage] * calls for stage, calls in self.remaining_calls.items())
+
+    def _tokens_per_second(self, stage, model_name):
+        return (self.throughput.tokens_per_second(stage, model_name)
+                or self.throughput.model_tokens_per_second(model_name)
+                or DEFAULT_TOKENS_PER_SECOND)
+
+    def _prompt_tokens_per_second(self, stage, model_name):
+        return (self.throughput.prompt_tokens_per_second(stage, model_name)
+                or self.throughput.model_prompt_tokens_per_second(model_name)
+                or DEFAULT_PROMPT_TOKENS_PER_SECOND)
+
+    def seconds_remaining(self):
+        if self.deadline_seconds is None:
+            return None
+        return self.deadline_seconds - (time.perf_counter() - self.start_time)
+
+    def _available_tokens(self, stage, model_name, prompt_tokens):
+        """Generated tokens left for all the remaining calls."""
+        available = None
+        if self.token_budget is not None:
+            available = max(0, self.token_budget - self.tokens_used)
+        seconds_remaining = self.seconds_remaining()
+        if seconds_remaining is not None:
+            prompt_seconds = prompt_tokens / self._prompt_tokens_per_second(stage, model_name)
+            generation_seconds = max(0.0, seconds_remaining * (1 - PROMPT_TIME_RESERVE) - prompt_seconds)
+            time_tokens = int(generation_seconds * self._tokens_per_second(stage, model_name))
+            available = time_tokens if available is None else min(available, time_tokens)
+        return available
+
+    def stage_options(self, stage, model_name, prompt_tokens, num_ctx):
+        """num_predict for the next call of a stage that runs with the given num_ctx."""
+        with self._lock:
+            available = self._available_tokens(stage, model_name, prompt_tokens)
+            # The minimum of this call is reserved even if it was not counted in remaining_calls
+            reserved = self._reserved_tokens()
+            remaining_share = self._remaining_share()
+            if self.remaining_calls.get(stage, 0) == 0:
+                reserved += MIN_NUM_PREDICT[stage]
+                remaining_share += self._call_share(stage)
+            spare = max(0, available - reserved)
+            num_predict = MIN_NUM_PREDICT[stage] + int(spare * self._call_share(stage) / remaining_share)
+
+            # Nothing longer than the context window can be generated
+            room = num_ctx - int(prompt_tokens * PROMPT_TOKEN_MARGIN)
+            num_predict = min(num_predict, room if room > 0 else num_ctx)
+            return {'num_predict': num_predict}
+
+    def call_deadline(self, stage, model_name, prompt_tokens):
+        """Seconds the next call of a stage may take, None when there is no deadline."""
+        seconds_remaining = self.seconds_remaining()
+        if seconds_remaining is None:
+            return None
+        shortest_call = (prompt_tokens / self._prompt_tokens_per_second(stage, model_name)
+                         + MIN_NUM_PREDICT[stage] / self._tokens_per_second(stage, model_name))
+        return max(CALL_TIME_MARGIN * shortest_call, seconds_remaining)
+
+    def should_skip(self, stage, model_name, prompt_tokens):
+        """True when an optional stage would not finish before the deadline or within the token budget."""
+        if stage not in OPTIONAL_STAGES:
+            return False
+        with self._lock:
+            if self.token_budget is not None and self.token_budget - self.tokens_used < MIN_NUM_PREDICT[stage]:
+                return True
+            seconds_remaining = self.seconds_remaining()
+            if seconds_remaining is None:
+                return False
+            needed_seconds = (prompt_tokens / self._prompt_tokens_per_second(stage, model_name)
+                              + MIN_NUM_PREDICT[stage] / self._tokens_per_second(stage, model_name))
+            return needed_seconds > seconds_remaining
+
+    def record(self, stage, ollama_response):
+        """Account for a completed call."""
+        with self._lock:
+            self.tokens_used += ollama_response.get('eval_count') or 0
+            if self.remaining_calls.get(stage, 0) > 0:
+                self.remaining_calls[stage] -= 1
+
+    def skip(self, stage):
+        """Account for a call that will not be made (e.g. already checkpointed or skipped)."""
+        with self._lock:
+            if self.remaining_calls.get(stage, 0) > 0:
+                self.remaining_calls[stage] -= 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        parts = [f"Used {self.tokens_used} generated tokens in {elapsed:.0f} seconds"]
+        if self.token_budget is not None:
+            parts.append(f"of a {self.token_budget} token budget")
+        if self.deadline_seconds is not None:
+            parts.append(f"with a {self.deadline_seconds:.0f} second deadline")
+        return " ".join(parts) + "."
@@ -1,11 +1,17 @@
 import json
 import os
+import threading
+from contextlib import contextmanager
 from functools import wraps
 
 # Global variable to store the checkpoint directory
 CHECKPOINT_DIRECTORY = None
 CHECKPOINT_CALL_COUNTER = 0
 
+# Guards the counter and the checkpoint file when checkpointed functions run on several threads
+CHECKPOINT_LOCK = threading.RLock()
+_PINNED_COUNTER = threading.local()
+
 def set_checkpoint_directory(directory):
     """Set the global directory for storing checkpoints."""
     global CHECKPOINT_DIRECTORY
@@ -17,7 +23,33 @@ def set_checkpoint_directory(directory):
 def reset_checkpoint_counter():
     """Reset the checkpoint counter."""
     global CHECKPOINT_CALL_COUNTER
-    CHECKPOINT_CALL_COUNTER = 0
+    with CHECKPOINT_LOCK:
+        CHECKPOINT_CALL_COUNTER = 0
+
+def reserve_checkpoint_counter():
+    """Reserve the next checkpoint call number.
+    
+    Checkpoint names depend on call order, so callers that run checkpointed functions
+    concurrently reserve the numbers up front, in order, and pin them on the worker
+    threads with pinned_checkpoint_counter."""
+    global CHECKPOINT_CALL_COUNTER
+    with CHECKPOINT_LOCK:
+        CHECKPOINT_CALL_COUNTER += 1
+        return CHECKPOINT_CALL_COUNTER
+
+@contextmanager
+def pinned_checkpoint_counter(counter):
+    """The next checkpointed call on this thread uses counter instead of the next global number."""
+    _PINNED_COUNTER.value = counter
+    try:
+        yield
+    finally:
+        _PINNED_COUNTER.value = None
+
+def checkpoint_exists(func, counter):
+    """True if the call of the checkpointed func with this call number has a checkpoint."""
+    with CHECKPOINT_LOCK:
+        return f"{func.__name__}-{counter}" in load_checkpoints()
 
 # Helper function to get the filepath for the checkpoint JSON file
 def get_checkpoint_filepath():
@@ -51,12 +83,16 @@ def checkpoint(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         # Use the function's name as the checkpoint name
-        global CHECKPOINT_CALL_COUNTER
-        CHECKPOINT_CALL_COUNTER += 1
-        checkpoint_name = f"{func.__name__}-{CHECKPOINT_CALL_COUNTER}"
+        counter = getattr(_PINNED_COUNTER, 'value', None)
+        if counter is None:
+            counter = reserve_checkpoint_counter()
+        else:
+            _PINNED_COUNTER.value = None
+        checkpoint_name = f"{func.__name__}-{counter}"
         
         # Load existing checkpoints
-        checkpoints = load_checkpoints()
+        with CHECKPOINT_LOCK:
+            checkpoints = load_checkpoints()
         
         # Check if the checkpoint already exists
         if checkpoint_name in checkpoints:
@@ -70,8 +106,11 @@ def checkpoint(func):
             # If no exception, add the checkpoint and save
             args_str = json.dumps([str(arg) for arg in args]).replace('"','')
             kwargs_str = json.dumps({k: str(v) for k, v in kwargs.items()}).replace('"','')
-            checkpoints[checkpoint_name] = {'args_str':args_str,'kwargs_str':kwargs_str}
-            save_checkpoints(checkpoints)
+            with CHECKPOINT_LOCK:
+                # Reload as other threads may have saved checkpoints while func was running
+                checkpoints = load_checkpoints()
+                checkpoints[checkpoint_name] = {'args_str':args_str,'kwargs_str':kwargs_str}
+                save_checkpoints(checkpoints)
             
             return result  # Return the function result
         except Exception as e:
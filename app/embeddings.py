@@ -0,0 +1,37 @@
+import time
+import numpy as np
+import ollama
+
+DEFAULT_EMBEDDING_MODEL = 'nomic-embed-text'
+
+def embed_texts(texts, model_name=DEFAULT_EMBEDDING_MODEL, host=None, batch_size=32, record_wait=None):
+    """
+    Embed a list of texts with an Ollama embedding model.
+
+    Args:
+        texts (list): The strings to embed.
+        model_name (str): The Ollama embedding model (must already be pulled).
+        host (str): Optional Ollama host, defaults to OLLAMA_HOST or localhost.
+        batch_size (int): Number of texts sent per request.
+        record_wait (callable): Optional, called with the seconds spent waiting on each request
+            (e.g. StageProfiler.record_wait).
+
+    Returns:
+        numpy.ndarray: A float32 matrix of shape (len(texts), dim) with L2 normalized rows,
+        so the dot product of two rows is their cosine similarity.
+    """
+    client = ollama.Client(host=host)
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        start_time = time.perf_counter()
+        response = client.embed(model=model_name, input=list(texts[start:start + batch_size]))
+        if record_wait is not None:
+            record_wait(time.perf_counter() - start_time)
+        vectors.extend(response['embeddings'])
+
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
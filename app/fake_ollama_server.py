@@ -0,0 +1,177 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A minimal stand-in for the Ollama HTTP API used to exercise the retry, timeout and
+# hedging behaviour of ResilientOllama without a GPU. It can inject stalls, server
+# errors and empty responses at a configurable rate.
+
+class FakeOllamaConfig:
+    def __init__(self,
+                 latency = 0.05,
+                 stall_rate = 0.0,
+                 stall_seconds = 30.0,
+                 stall_first = 0,
+                 error_rate = 0.0,
+                 empty_rate = 0.0,
+                 tokens_per_second = 50.0,
+                 models = None,
+                 context_length = 32*1024,
+                 num_parallel = None,
+                 seed = None):
+        self.latency = latency
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        # The first stall_first generate requests always stall
+        self.stall_first = stall_first
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.tokens_per_second = tokens_per_second
+        self.models = models or ['llama3.3:latest']
+        self.context_length = context_length
+        # Like OLLAMA_NUM_PARALLEL, requests beyond this many wait for a free slot
+        self.slots = threading.Semaphore(num_parallel) if num_parallel else None
+        self.random = random.Random(seed)
+        self.requests = 0
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    config = None  # Set on the subclass created by start_fake_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on a stalled request
+            pass
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send_json(200, {'models': [{'name': model, 'model': model} for model in self.config.models]})
+        else:
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        request = self._read_json()
+        if self.path == '/api/generate':
+            self._generate(request)
+        elif self.path == '/api/show':
+            self._send_json(200, {'model_info': {'llama.context_length': self.config.context_length}})
+        elif self.path == '/api/embed':
+            self._embed(request)
+        else:
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+
+    def _generate(self, request):
+        config = self.config
+        config.requests += 1
+        roll = config.random.random()
+
+        if config.requests <= config.stall_first or roll < config.stall_rate:
+            time.sleep(config.stall_seconds)
+        elif roll < config.stall_rate + config.error_rate:
+            self._send_json(503, {'error': 'server overloaded'})
+            return
+
+        prompt = request.get('prompt') or ''
+        num_predict = (request.get('options') or {}).get('num_predict') or 64
+        if num_predict < 0:
+            num_predict = 64
+        eval_seconds = num_predict / config.tokens_per_second
+        if config.slots is not None:
+            with config.slots:
+                time.sleep(config.latency + eval_seconds)
+        else:
+            time.sleep(config.latency + eval_seconds)
+
+        empty = config.random.random() < config.empty_rate
+        response = '' if empty else ' '.join(['token'] * num_predict)
+        self._send_json(200, {
+            'model': request.get('model'),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'response': response,
+            'done': True,
+            'done_reason': 'stop',
+            'total_duration': int((config.latency + eval_seconds) * 1e9),
+            'load_duration': 0,
+            'prompt_eval_count': len(prompt) // 4,
+            'prompt_eval_duration': int(config.latency * 1e9),
+            'eval_count': 0 if empty else num_predict,
+            'eval_duration': int(eval_seconds * 1e9),
+        })
+
+    def _embed(self, request):
+        texts = request.get('input') or []
+        if isinstance(texts, str):
+            texts = [texts]
+        embeddings = []
+        for text in texts:
+            # Deterministic pseudo embedding from the words of the text
+            vector = [0.0] * 64
+            for word in text.lower().split():
+                vector[zlib.crc32(word.encode('utf-8')) % 64] += 1.0
+            embeddings.append(vector)
+        self._send_json(200, {'model': request.get('model'), 'embeddings': embeddings})
+
+
+def start_fake_server(host = '127.0.0.1', port = 0, **config_kwargs):
+    """Start a fake Ollama server on a background thread.
+    Returns the server; its url is f"http://{host}:{server.server_port}".
+    Call server.shutdown() to stop it."""
+    config = FakeOllamaConfig(**config_kwargs)
+    handler = type('ConfiguredFakeOllamaHandler', (FakeOllamaHandler,), {'config': config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.config = config
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama server that injects stalls and errors")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.05, help="Base latency of each generate call in seconds")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Fraction of generate calls that stall")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="How long a stalled call hangs")
+    parser.add_argument("--stall-first", type=int, default=0, help="Number of generate calls that stall at start up")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of generate calls that return HTTP 503")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="Fraction of generate calls with an empty response")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Simulated generation speed")
+    parser.add_argument("--num-parallel", type=int, default=None, help="Number of generate calls served at once")
+    parser.add_argument("--model", action="append", default=None, help="Model name to advertise (repeatable)")
+
+    args = parser.parse_args()
+    server = start_fake_server(args.host, args.port,
+                               latency=args.latency,
+                               stall_rate=args.stall_rate,
+                               stall_seconds=args.stall_seconds,
+                               stall_first=args.stall_first,
+                               error_rate=args.error_rate,
+                               empty_rate=args.empty_rate,
+                               tokens_per_second=args.tokens_per_second,
+                               num_parallel=args.num_parallel,
+                               models=args.model)
+    print(f"Fake Ollama server listening on http://{args.host}:{server.server_port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,15 +1,29 @@
 import os
+import json
 import uuid
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import ollama
 import markdown2
 from weasyprint import HTML
 import mdformat
 from app.youtube_transcribe import extract_video_id, get_transcript, get_video_title, get_video_thumbnail, chunk_text
 from app import prompts
 from app.ollama_utils import OllamaUtils
-from app.checkpoint import set_checkpoint_directory, checkpoint
+from app.checkpoint import (set_checkpoint_directory, checkpoint, checkpoint_exists,
+                            reserve_checkpoint_counter, pinned_checkpoint_counter)
+from app.throughput import ThroughputTracker
+from app.llm_client import ResilientOllama
+from app.summary_index import SummaryIndex
+from app.embeddings import DEFAULT_EMBEDDING_MODEL
+from app.retrieval import ChunkSummaryRetriever, estimate_tokens, BYTES_PER_TOKEN
+from app.autotune import AdaptiveConcurrencyController, load_concurrency
+from app.budget_planner import GenerationBudgetPlanner
+from app.profiling import StageProfiler
+
+# The pipeline stages that call the LLM. Each stage can use its own model and options
+# e.g. a small fast model for the 'map' (chunk summary) stage and a large model for the rest.
+STAGES = ('map', 'introduction', 'main_body', 'conclusion', 'final')
 
 class LexPodcastSummary:
     def __init__(self, podcast_url, *, results_dir = None):
@@ -40,6 +54,33 @@ class LexPodcastSummary:
         self.num_cxt = 32*1024
         self.raw_text_chunk_size = 32*1024
         self.text_chunk_overlay_size = 100
+
+        # Per stage overrides of model_name, temperature, num_cxt and extra ollama options
+        self.stage_config = {stage: {} for stage in STAGES}
+        # (model, num_ctx) pairs checked with _validate_model, checked again when the hosts change
+        self._validated_models = set()
+        self._ollama_utils = {}
+        self.throughput = ThroughputTracker(f"{self.results_dir}/throughput.json")
+        self.llm = ResilientOllama()
+
+        # Search index updated after each report, None to not index
+        self.index_dir = None
+        self.index_embedding_model = DEFAULT_EMBEDDING_MODEL
+
+        # Token budget of chunk summaries sent to the introduction and conclusion, 0 sends them all
+        self.retrieval_token_budget = 8*1024
+        self.retrieval_embedding_model = DEFAULT_EMBEDDING_MODEL
+
+        # Number of chunks summarized at once, or 'auto' to use the autotuned setting
+        self.map_concurrency = 1
+        self.adaptive_concurrency = False
+        self.max_concurrency = None
+
+        # Plans num_predict of every call to meet a deadline or token budget, see config_budget
+        self.budget_planner = None
+
+        # Per stage cProfile and tracemalloc reports, see config_profiling
+        self.profiler = StageProfiler(f"{self.results_dir}/profile")
                         
     
     @property
@@ -107,32 +148,132 @@ class LexPodcastSummary:
     
     def _chunk_transcript(self):
         """Simplifies the call to chunk_text because we already know all the parameters"""
-        return chunk_text(self.transcript_file_path, self.raw_text_chunk_size, self.text_chunk_overlay_size)
+        chunks = chunk_text(self.transcript_file_path, self.raw_text_chunk_size, self.text_chunk_overlay_size)
+
+        # Record where each chunk sits in the transcript so chunk summaries can be linked back to timestamps
+        step = self.raw_text_chunk_size - self.text_chunk_overlay_size
+        chunk_offsets = [[index*step, index*step + len(chunk)] for index, chunk in enumerate(chunks)]
+        with open(f"{self.results_dir}/chunk_offsets.json", 'w') as file:
+            json.dump(chunk_offsets, file)
+        return chunks
 
     
+    def _map_concurrency(self):
+        """ The number of chunks to summarize at once. 'auto' uses the settings saved by app.autotune
+        for the map model and num_ctx (the budget planner leaves num_ctx as configured) on each host.
+        Requests are spread round robin over the hosts, so with several hosts each gets an equal share
+        and the slowest host sets the pace. """
+        if self.map_concurrency != 'auto':
+            return self.map_concurrency
+        model_name = self._stage_model('map')
+        num_ctx = self._stage_num_ctx('map')
+        host_concurrency = []
+        for host in self.llm.hosts:
+            concurrency = load_concurrency(host, model_name, num_ctx)
+            if concurrency is None:
+                print(f"No autotuned concurrency for {model_name} (num_ctx {num_ctx}) on {host}, "
+                      f"run python -m app.autotune {model_name} --host {host} --num-ctx {num_ctx}. Using 1.")
+                return 1
+            host_concurrency.append(concurrency)
+        return min(host_concurrency) * len(host_concurrency)
+
     def _summarize_chunks(self, chunks, max_summary_response_size):
         """ Summarize each chunk of the transcript individually 
-        NOTE: OLLAMA_NUM_PARALLEL=3 does work if you map multiple processes but it does not save time."""
-        for index, chunk in enumerate(chunks):
-            print(f"Starting to process chunk {index +1}")
-            self._summarize_chunk(chunk, max_summary_response_size, index +1)
+        Whether running requests concurrently saves time depends on the model size, num_ctx,
+        the server's OLLAMA_NUM_PARALLEL and the hardware, use python -m app.autotune to measure it."""
+        concurrency = self._map_concurrency()
+        if concurrency <= 1 and not self.adaptive_concurrency:
+            for index, chunk in enumerate(chunks):
+                print(f"Starting to process chunk {index +1}")
+                ollama_response = self._summarize_chunk(chunk, max_summary_response_size, index +1)
+                self._account_checkpointed('map', ollama_response)
+            return
+
+        controller = AdaptiveConcurrencyController(concurrency,
+                                                   max_concurrency=self.max_concurrency,
+                                                   adaptive=self.adaptive_concurrency)
+        print(f"Summarizing chunks with concurrency {controller.limit} (adaptive {self.adaptive_concurrency}).")
+
+        # Checkpoint names are numbered in call order, reserve them in chunk order so a resumed run matches
+        counters = [reserve_checkpoint_counter() for _ in chunks]
+
+        def summarize(index, chunk, counter):
+            with controller.slot():
+                print(f"Starting to process chunk {index +1}")
+                with pinned_checkpoint_counter(counter):
+                    ollama_response = self._summarize_chunk(chunk, max_summary_response_size, index +1)
+            self._account_checkpointed('map', ollama_response)
+            if ollama_response is not None:
+                controller.record(ollama_response.get('eval_count') or 0)
+
+        with ThreadPoolExecutor(max_workers=controller.max_concurrency) as executor:
+            futures = [executor.submit(summarize, index, chunk, counter)
+                       for index, (chunk, counter) in enumerate(zip(chunks, counters))]
+            for future in futures:
+                future.result()
+
+    def _stage_model(self, stage):
+        """ The model used for a stage, falling back to the global model_name """
+        return self.stage_config[stage].get('model_name', self.model_name)
+
+    def _stage_num_ctx(self, stage):
+        """ The context window used for a stage, falling back to the global num_cxt """
+        return self.stage_config[stage].get('num_cxt', self.num_cxt)
+
+    def _stage_options(self, stage):
+        """ The ollama options for a stage """
+        stage_config = self.stage_config[stage]
+        options = {'temperature': stage_config.get('temperature', self.temperature),
+                   'num_ctx': self._stage_num_ctx(stage)}
+        options.update(stage_config.get('options', {}))
+        return options
+
+    def _generate(self, stage, prompt, system):
+        """ Call ollama.generate with the model and options configured for the stage
+        and record the throughput of the call. Timeouts, retries and hedging are handled by self.llm """
+        model_name = self._stage_model(stage)
+        options = self._stage_options(stage)
+        deadline = None
+        if self.budget_planner is not None:
+            prompt_tokens = estimate_tokens(system + prompt)
+            options.update(self.budget_planner.stage_options(stage, model_name, prompt_tokens, options['num_ctx']))
+            deadline = self.budget_planner.call_deadline(stage, model_name, prompt_tokens)
+
+        start_time = time.perf_counter()
+        ollama_response = self.llm.generate(
+            stage,
+            deadline = deadline,
+            model = model_name,
+            prompt = prompt,
+            system = system,
+            options = options
+            )
+        wall_time = time.perf_counter() - start_time
+        self.profiler.record_wait(wall_time)
+        self.throughput.record(stage, model_name, ollama_response, wall_time)
+        self.throughput.save()
+        if self.budget_planner is not None:
+            self.budget_planner.record(stage, ollama_response)
+        return ollama_response
+
+    def _account_checkpointed(self, stage, result):
+        """ A checkpointed call returns None without calling the LLM, the budget planner should not wait for it """
+        if result is None and self.budget_planner is not None:
+            self.budget_planner.skip(stage)
 
     @checkpoint
     def _summarize_chunk(self, context: str, max_summary_response_size: int, chunk_index: int) -> str:
         start_time = time.perf_counter()
         summarize_chunk_prompt = prompts.SUMMARIZE_CHUNK_PROMPT.format(max_summary_response_size=max_summary_response_size)
         
-        ollama_response = ollama.generate(
-            model = self.model_name, 
+        ollama_response = self._generate(
+            'map',
             prompt = f"== Title ==: {self.title}\n== Context ==\n{context}\n\n{summarize_chunk_prompt}",
-            system = prompts.MAIN_SYSTEM_PROMPT,
-            options = {'temperature':self.temperature, 'num_ctx':self.num_cxt}
+            system = prompts.MAIN_SYSTEM_PROMPT
             )
         
-        if ollama_response.get('response') is not None:
-            self._save_summarize_chunk_context(ollama_response['response'], chunk_index)
-        else:
-            print("THIS IS A PROBLEM: No Response generated for Chunk {chunk_index}.")
+        # An empty response raises an error in self.llm so the checkpoint is not saved
+        self._save_summarize_chunk_context(ollama_response['response'], chunk_index)
             
         formatted_time = self._elapsed_time(start_time)
         print(f"Total time for summarize_chunk of chunk {chunk_index} {formatted_time}.")
@@ -145,13 +286,8 @@ class LexPodcastSummary:
         with open(filename, 'w') as file:
             file.write(str(content))
     
-    def _read_and_concatenate_summaries(self):
-        full_content = ""
-        if self.title:
-            title_header = f"== TITLE ==\n"
-            full_content += title_header
-            full_content += self.title + "\n"
-            
+    def _read_summaries(self):
+        """ Read the chunk summaries in chunk order """
         files = os.listdir(self.results_dir)
         
         # Filter files that start with 'chunk_results_' and end with '.txt'
@@ -160,20 +296,49 @@ class LexPodcastSummary:
         # Sort the files based on the numeric part after 'chunk_results_'
         chunk_files.sort(key=lambda x: int(x.split('_')[2].split('.')[0]))
         
-        # Iterate over each sorted chunk file
-        for index, filename in enumerate(chunk_files, start=1):
+        summaries = []
+        for filename in chunk_files:
             file_path = os.path.join(self.results_dir, filename)
             with open(file_path, 'r') as file:
-                # Read the content of the file
-                content = file.read()
-            
-            # Create a header for the subcontext
-            subcontext_header = f"== SubContext {index+1} ==\n"
-            
-            # Append the header and content to the full_content string
-            full_content += subcontext_header + content + "\n"
+                summaries.append(file.read())
+        return summaries
+
+    def _concatenate_summaries(self, summaries, selected = None):
+        """ Join the summaries (or only the selected indexes) under a title and SubContext headers """
+        parts = []
+        if self.title:
+            parts.append(f"== TITLE ==\n{self.title}\n")
+
+        if selected is None:
+            selected = range(len(summaries))
+        for index in selected:
+            # Headers keep the position of the summary in the full transcript
+            parts.append(f"== SubContext {index+2} ==\n{summaries[index]}\n")
         
-        return full_content
+        return "".join(parts)
+
+    def _section_contents(self, summaries):
+        """ The content for the introduction and conclusion prompts.
+        Rather than every chunk summary, each gets a token budgeted subset: the opening (or closing)
+        summary plus the summaries most representative of the main themes.
+        Falls back to all the summaries if retrieval is disabled or the embedding model is unavailable. """
+        full_content = self._concatenate_summaries(summaries)
+        if not self.retrieval_token_budget or not summaries:
+            return full_content, full_content
+
+        try:
+            retriever = ChunkSummaryRetriever(summaries, self.retrieval_embedding_model, self.llm.hosts[0],
+                                              record_wait=self.profiler.record_wait)
+        except Exception as e:
+            print(f"Retrieval disabled, could not embed the chunk summaries: {e}")
+            return full_content, full_content
+
+        introduction_selected = retriever.select(self.retrieval_token_budget, anchors=(0,))
+        conclusion_selected = retriever.select(self.retrieval_token_budget, anchors=(-1,))
+        print(f"Introduction uses {len(introduction_selected)} and conclusion uses {len(conclusion_selected)} "
+              f"of {len(summaries)} chunk summaries.")
+        return (self._concatenate_summaries(summaries, introduction_selected),
+                self._concatenate_summaries(summaries, conclusion_selected))
     
     @checkpoint
     def _main_body_text(self, concatenated_content):
@@ -181,11 +346,10 @@ class LexPodcastSummary:
         prompt = prompts.CREATE_REPORT_BODY_PROMPT
         system_prompt = prompts.REPORT_SECTION_SYSTEM_PROMPT
         
-        ollama_response = ollama.generate(
-            model = self.model_name,
+        ollama_response = self._generate(
+            'main_body',
             prompt=f"{concatenated_content}\n{prompt}",
-            system=system_prompt,
-            options={'temperature':self.temperature,'num_ctx':self.num_cxt}
+            system=system_prompt
         )
         main_body_text = ollama_response.get('response')
         file_path = f"{self.results_dir}/main_body.txt"
@@ -199,11 +363,10 @@ class LexPodcastSummary:
         prompt = prompts.CREATE_INTRODUCTION_PROMPT
         system_prompt = prompts.REPORT_SECTION_SYSTEM_PROMPT
         
-        ollama_response = ollama.generate(
-            model = self.model_name,
+        ollama_response = self._generate(
+            'introduction',
             prompt=f"{concatenated_content}\n{prompt}",
-            system=system_prompt,
-            options={'temperature':self.temperature,'num_ctx':self.num_cxt}
+            system=system_prompt
         )
         main_body_text = ollama_response.get('response')
         file_path = f"{self.results_dir}/introduction.txt"
@@ -217,11 +380,10 @@ class LexPodcastSummary:
         prompt = prompts.CREATE_CONCLUSION_PROMPT
         system_prompt = prompts.REPORT_SECTION_SYSTEM_PROMPT
         
-        ollama_response = ollama.generate(
-            model = self.model_name,
+        ollama_response = self._generate(
+            'conclusion',
             prompt=f"{concatenated_content}\n{prompt}",
-            system=system_prompt,
-            options={'temperature':self.temperature,'num_ctx':self.num_cxt}
+            system=system_prompt
         )
         main_body_text = ollama_response.get('response')
         file_path = f"{self.results_dir}/conclusion.txt"
@@ -235,11 +397,10 @@ class LexPodcastSummary:
         prompt = prompts.CREATE_FINAL_REPORT_PROMPT
         system_prompt = prompts.FINAL_REPORT_SYSTEM_PROMPT
         
-        ollama_response = ollama.generate(
-            model = self.model_name,
+        ollama_response = self._generate(
+            'final',
             prompt=f"{concatenated_content}\n{prompt}",
-            system=system_prompt,
-            options={'temperature':self.temperature,'num_ctx':self.num_cxt}
+            system=system_prompt
         )
         main_body_text = ollama_response.get('response')
         file_path = f"{self.results_dir}/final_report.txt"
@@ -267,31 +428,32 @@ class LexPodcastSummary:
     ###############################################################3
     # Putting it all together
     
+    def _validate_model(self, model_name, num_ctx = None, hosts = None):
+        """ Check the model exists and num_ctx fits in its context window on every Ollama host """
+        for host in hosts or self.llm.hosts:
+            if host not in self._ollama_utils:
+                self._ollama_utils[host] = OllamaUtils(host)
+            self._ollama_utils[host].validate_model(model_name, num_ctx)
+        self._validated_models.add((model_name, num_ctx))
+
     def config(self,
                 model_name = None, 
                 temperature = None,
                 num_cxt = None,
                 raw_text_chunk_size = None,
                 text_chunk_overlay_size = None):
-        
-        ollama_utils = OllamaUtils()
 
         if model_name is not None:
-            if ollama_utils.model_exists(model_name):
-                self.model_name = model_name
-            else:
-                raise KeyError(f"Model {model_name} does not exists")
+            self._validate_model(model_name)
+            self.model_name = model_name
             
         if temperature is not None:
             self.temperature = temperature
             
         # Define the Context Window Size for the Model
         if num_cxt is not None:
-            max_num_ctx = ollama_utils.model_context_size(model_name)
-            if num_cxt <= max_num_ctx:
-                self.num_cxt = num_cxt # Tokens (Note a token is ~4 Bytes)
-            else:
-                raise Exception("ERROR: num-ctx provided is larger than max_num_ctx ")
+            self._validate_model(self.model_name, num_cxt)
+            self.num_cxt = num_cxt # Tokens (Note a token is ~4 Bytes)
             
         # Chunk the raw transcript text into xxk (32k) Byte Chunks for processing as 
         # if the full text is to large the Context Window size
@@ -303,44 +465,171 @@ class LexPodcastSummary:
         if text_chunk_overlay_size is not None:
             self.text_chunk_overlay_size = text_chunk_overlay_size
 
+    def config_llm_client(self,
+                hosts = None,
+                deadlines = None,
+                default_deadline = None,
+                max_retries = None,
+                hedge_percentile = None):
+        """ Configure how the LLM is called.
+        hosts: Ollama endpoints to use, requests are spread round robin and hedged across them.
+        deadlines: dict of stage to seconds a call may take, including all of its retries.
+        default_deadline: seconds for stages not in deadlines.
+        max_retries: retries with exponential backoff after a timeout or server error, while the deadline allows.
+        hedge_percentile: e.g. 95, send a duplicate request to another host once a call
+        is slower than this latency percentile of the stage. None disables hedging. """
+        llm_kwargs = {'hosts': hosts or self.llm.hosts,
+                      'deadlines': deadlines if deadlines is not None else self.llm.deadlines,
+                      'default_deadline': default_deadline if default_deadline is not None else self.llm.default_deadline,
+                      'max_retries': max_retries if max_retries is not None else self.llm.max_retries,
+                      'hedge_percentile': hedge_percentile if hedge_percentile is not None else self.llm.hedge_percentile}
+        # Models configured before the hosts were set must exist on the new hosts too
+        for model_name, num_ctx in sorted(self._validated_models, key=str):
+            self._validate_model(model_name, num_ctx, llm_kwargs['hosts'])
+        self.llm = ResilientOllama(**llm_kwargs)
+
+    def config_concurrency(self, concurrency = None, adaptive = None, max_concurrency = None):
+        """ Configure how many chunks are summarized at once.
+        concurrency: number of concurrent requests, or 'auto' for the setting found by python -m app.autotune
+        adaptive: adjust the concurrency during the run when throughput drops
+        max_concurrency: upper limit for the adaptive controller (default twice the starting concurrency) """
+        if concurrency is not None:
+            if concurrency != 'auto' and int(concurrency) < 1:
+                raise ValueError("concurrency must be at least 1 or 'auto'")
+            self.map_concurrency = concurrency if concurrency == 'auto' else int(concurrency)
+        if adaptive is not None:
+            self.adaptive_concurrency = adaptive
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+
+    def config_profiling(self, enabled = True):
+        """ Profile each pipeline stage with cProfile and tracemalloc. The .pstats files and
+        allocation reports are written to the profile directory in the results directory. """
+        self.profiler.enabled = enabled
+
+    def config_budget(self, deadline_seconds = None, token_budget = None):
+        """ Bound the run by a wall-clock deadline and/or a budget of generated tokens.
+        num_predict of every call is planned from the tokens/sec measured so far and no call
+        may run past the deadline (but each gets at least a minute); as the deadline
+        approaches the sections get shorter and the final polish may be skipped. """
+        if deadline_seconds is None and token_budget is None:
+            self.budget_planner = None
+        else:
+            self.budget_planner = GenerationBudgetPlanner(self.throughput,
+                                                          deadline_seconds=deadline_seconds,
+                                                          token_budget=token_budget)
+
+    def config_retrieval(self, token_budget = None, embedding_model = None):
+        """ Configure the retrieval of chunk summaries for the introduction and conclusion.
+        token_budget: tokens of chunk summaries sent to each of these sections, 0 sends them all.
+        The main body always gets every chunk summary. """
+        if token_budget is not None:
+            self.retrieval_token_budget = token_budget
+        if embedding_model is not None:
+            self.retrieval_embedding_model = embedding_model
+
+    def config_index(self, index_dir, embedding_model = DEFAULT_EMBEDDING_MODEL):
+        """ Add the summaries to the cross-episode search index in index_dir after each report.
+        embedding_model None indexes for keyword search only. """
+        self.index_dir = index_dir
+        self.index_embedding_model = embedding_model
+
+    def config_stage(self,
+                stage,
+                model_name = None,
+                temperature = None,
+                num_cxt = None,
+                options = None):
+        """ Override the model and options for a single pipeline stage.
+        stage is one of 'map', 'introduction', 'main_body', 'conclusion' or 'final'.
+        Anything not given falls back to the values set with config(). """
+        if stage not in STAGES:
+            raise KeyError(f"Unknown stage {stage}, expected one of {STAGES}")
+
+        stage_config = dict(self.stage_config[stage])
+        if model_name is not None:
+            stage_config['model_name'] = model_name
+        if temperature is not None:
+            stage_config['temperature'] = temperature
+        if num_cxt is not None:
+            stage_config['num_cxt'] = num_cxt
+        if options is not None:
+            stage_config['options'] = dict(options)
+
+        # The stage may inherit num_cxt from config() so validate the combination actually used
+        self._validate_model(stage_config.get('model_name', self.model_name),
+                             stage_config.get('num_cxt', self.num_cxt))
+        self.stage_config[stage] = stage_config
+
     def create_summary_report(self):
         total_time_start = time.perf_counter()
-        self._get_title_and_transcript()
-        chunks = self._chunk_transcript()
+        with self.profiler.stage('transcript'):
+            self._get_title_and_transcript()
+        with self.profiler.stage('chunk'):
+            chunks = self._chunk_transcript()
         print(f"We have {len(chunks)} chunks.")
-        print(f"We are use {self.model_name}.")
+        for stage in STAGES:
+            print(f"We are use {self._stage_model(stage)} for {stage} (num_ctx {self._stage_num_ctx(stage)}).")
         
         # We do not want to exceed to context window when we add all the summary chunks together
         # Rational: We know the context window is made of tokens each token is approximately 4 bytes
         # We can be very conservative and only use 1/2 the context for the summary text
         # The rest can be for detailed prompts
-        
-        max_summary_response_size = ((self.num_cxt * 4)*0.6)/len(chunks)
+        # The section stages receive all the summaries so the smallest of their context windows applies
+        section_num_ctx = min(self._stage_num_ctx(stage) for stage in ('introduction', 'main_body', 'conclusion'))
+        max_summary_response_size = ((section_num_ctx * 4)*0.6)/len(chunks)
+
+        if self.budget_planner is not None:
+            # Keep the size hint in the prompt in line with the num_predict the planner gives each chunk
+            self.budget_planner.start(len(chunks), total_time_start)
+            map_prompt_tokens = estimate_tokens(prompts.MAIN_SYSTEM_PROMPT + prompts.SUMMARIZE_CHUNK_PROMPT + chunks[0])
+            map_options = self.budget_planner.stage_options('map', self._stage_model('map'), map_prompt_tokens, self._stage_num_ctx('map'))
+            max_summary_response_size = min(max_summary_response_size, map_options['num_predict'] * BYTES_PER_TOKEN)
         print(f"Max Response size {max_summary_response_size}")
         
         start_time = time.perf_counter()
-        self._summarize_chunks(chunks, max_summary_response_size)
+        with self.profiler.stage('map'):
+            self._summarize_chunks(chunks, max_summary_response_size)
         
         formatted_time = self._elapsed_time(start_time)
         print(f"Total time to summarize chunk(s) took {formatted_time}.")
         
-        concatenated_content = self._read_and_concatenate_summaries()
+        # Reserved in the order the sections are written so checkpoint names match a sequential run
+        introduction_counter, main_body_counter, conclusion_counter = (reserve_checkpoint_counter() for _ in range(3))
+        with self.profiler.stage('concatenate'):
+            summaries = self._read_summaries()
+            concatenated_content = self._concatenate_summaries(summaries)
+            if (checkpoint_exists(self._introduction_text, introduction_counter)
+                    and checkpoint_exists(self._conclusion_text, conclusion_counter)):
+                # Both sections are already written, there is nothing to retrieve for
+                introduction_content, conclusion_content = concatenated_content, concatenated_content
+            else:
+                introduction_content, conclusion_content = self._section_contents(summaries)
 
         start_time = time.perf_counter()
-        introduction_text = self._introduction_text(concatenated_content)
-        introduction_text = introduction_text if introduction_text else self._load_text('introduction.txt')
+        with self.profiler.stage('introduction'):
+            with pinned_checkpoint_counter(introduction_counter):
+                introduction_text = self._introduction_text(introduction_content)
+            self._account_checkpointed('introduction', introduction_text)
+            introduction_text = introduction_text if introduction_text else self._load_text('introduction.txt')
         formatted_time = self._elapsed_time(start_time)
         print(f"Total time write the introduction took {formatted_time}.")
 
         start_time = time.perf_counter()
-        main_body_text = self._main_body_text(concatenated_content)
-        main_body_text = main_body_text if main_body_text else self._load_text('main_body.txt')
+        with self.profiler.stage('main_body'):
+            with pinned_checkpoint_counter(main_body_counter):
+                main_body_text = self._main_body_text(concatenated_content)
+            self._account_checkpointed('main_body', main_body_text)
+            main_body_text = main_body_text if main_body_text else self._load_text('main_body.txt')
         formatted_time = self._elapsed_time(start_time)
         print(f"Total time to write the main body took {formatted_time}.")
 
         start_time = time.perf_counter()
-        conclusion_text = self._conclusion_text(concatenated_content)
-        conclusion_text = conclusion_text if conclusion_text else self._load_text('conclusion.txt')
+        with self.profiler.stage('conclusion'):
+            with pinned_checkpoint_counter(conclusion_counter):
+                conclusion_text = self._conclusion_text(conclusion_content)
+            self._account_checkpointed('conclusion', conclusion_text)
+            conclusion_text = conclusion_text if conclusion_text else self._load_text('conclusion.txt')
         formatted_time = self._elapsed_time(start_time)
         print(f"Total time to write the conclusion took {formatted_time}.")
         
@@ -355,16 +644,46 @@ class LexPodcastSummary:
             f"{conclusion_text}"
         )
         start_time = time.perf_counter()
-        final_report_text = self._final_report_text(draft_report)
-        final_report_text = final_report_text if final_report_text else self._load_text('final_report.txt')
+        with self.profiler.stage('final'):
+            if (self.budget_planner is not None
+                    and self.budget_planner.should_skip('final', self._stage_model('final'), estimate_tokens(draft_report))):
+                # Out of time (or tokens): use the draft sections as they are rather than polishing them
+                print("Skipping the final report polish to stay within the budget.")
+                final_report_text = (f"# {self.title}\n\n## Introduction\n\n{introduction_text}\n\n"
+                                     f"{main_body_text}\n\n## Conclusion\n\n{conclusion_text}")
+                with open(f"{self.results_dir}/final_report.txt", 'w') as file:
+                    file.write(final_report_text)
+            else:
+                final_report_text = self._final_report_text(draft_report)
+                final_report_text = final_report_text if final_report_text else self._load_text('final_report.txt')
         formatted_time = self._elapsed_time(start_time)
         print(f"Total time to write finalize the report took {formatted_time}.")
 
         print("--"*40)
         #print(final_report_text)
-        self._markdown_to_pdf(final_report_text)
+        with self.profiler.stage('pdf'):
+            self._markdown_to_pdf(final_report_text)
+
+        if self.index_dir is not None:
+            start_time = time.perf_counter()
+            with self.profiler.stage('index'):
+                try:
+                    summary_index = SummaryIndex(self.index_dir, embedding_model=self.index_embedding_model,
+                                                 host=self.llm.hosts[0], record_wait=self.profiler.record_wait)
+                    added = summary_index.add_episode(self.results_dir)
+                    formatted_time = self._elapsed_time(start_time)
+                    print(f"Added {added} passages to the search index in {self.index_dir} took {formatted_time}.")
+                except Exception as e:
+                    # The report is done, the episode can be indexed later with summary_search.py build
+                    print(f"Error updating the search index in {self.index_dir}: {e}")
         
         formatted_time = self._elapsed_time(total_time_start)
         print("="*60)
+        print(self.throughput.summary())
+        print(self.llm.tail_summary())
+        if self.budget_planner is not None:
+            print(self.budget_planner.summary())
+        if self.profiler.enabled:
+            print(self.profiler.summary())
         print(f"Total time to execute took {formatted_time}.")
     
\ No newline at end of file
@@ -0,0 +1,230 @@
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+import httpx
+import ollama
+
+DEFAULT_DEADLINE_SECONDS = 30*60
+
+class LLMCallError(RuntimeError):
+    """Raised when an LLM call fails after all retries."""
+
+class EmptyResponseError(LLMCallError):
+    """Raised when the server answers but generates no text."""
+
+class DeadlineExceededError(LLMCallError):
+    """Raised when a call, including its retries, does not complete within the stage deadline."""
+
+def _percentile(values, percentile):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def _is_retryable(error):
+    """Server overload, timeouts, connection problems and empty responses are worth retrying.
+    Client errors (e.g. 404 model not found) are not."""
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, (httpx.TransportError, ConnectionError, EmptyResponseError, DeadlineExceededError))
+
+
+class ResilientOllama:
+    """A wrapper around ollama.generate with per-stage deadlines, bounded
+    exponential-backoff retries and optional hedged requests.
+
+    The deadline bounds the whole call: every attempt, and the backoff between attempts,
+    has to fit in it. Each attempt but the last is given up after deadline / (max_retries + 1)
+    seconds, so a stalled request is retried while time is left; the last attempt may use
+    whatever remains. Server errors and empty responses are retried in the same way.
+
+    Hedging: once a stage has `hedge_min_samples` latencies recorded, a call that
+    is still running after the `hedge_percentile` latency of the stage is duplicated
+    on the next endpoint in `hosts`. The first successful result wins. Hedging needs
+    at least two hosts.
+
+    Requests run on daemon threads, each with its own client. The client of a request
+    that is given up on (or loses a hedge race) is closed, so it neither keeps its
+    connection nor keeps the interpreter from exiting.
+    """
+    def __init__(self,
+                 hosts = None,
+                 deadlines = None,
+                 default_deadline = DEFAULT_DEADLINE_SECONDS,
+                 max_retries = 3,
+                 backoff_base = 2.0,
+                 backoff_max = 60.0,
+                 hedge_percentile = None,
+                 hedge_min_samples = 5):
+        if hosts is None:
+            hosts = [os.getenv('OLLAMA_HOST', 'http://localhost:11434')]
+        if not hosts:
+            raise ValueError("At least one Ollama host is required")
+        self.hosts = list(hosts)
+        self.deadlines = dict(deadlines or {})
+        self.default_deadline = default_deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+        self._next_host = 0
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def _deadline(self, stage):
+        return self.deadlines.get(stage, self.default_deadline)
+
+    def _pick_hosts(self):
+        """Round robin over the hosts. Returns the primary host and the hedge host (or None)."""
+        with self._lock:
+            index = self._next_host
+            self._next_host = (self._next_host + 1) % len(self.hosts)
+        primary = self.hosts[index]
+        hedge = self.hosts[(index + 1) % len(self.hosts)] if len(self.hosts) > 1 else None
+        return primary, hedge
+
+    def _stage_stats(self, stage):
+        with self._lock:
+            return self.stats.setdefault(stage, {
+                'calls': 0, 'failures': 0, 'retries': 0, 'timeouts': 0,
+                'errors': 0, 'hedges': 0, 'hedge_wins': 0, 'latencies': [],
+            })
+
+    def _count(self, stage, name, amount=1):
+        stats = self._stage_stats(stage)
+        with self._lock:
+            stats[name] += amount
+
+    def _hedge_delay(self, stage):
+        """Seconds to wait before sending a hedged request, or None to not hedge."""
+        if self.hedge_percentile is None or len(self.hosts) < 2:
+            return None
+        latencies = self._stage_stats(stage)['latencies']
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return _percentile(latencies, self.hedge_percentile)
+
+    def _call(self, client, host, kwargs):
+        ollama_response = client.generate(**kwargs)
+        if not ollama_response.get('response'):
+            raise EmptyResponseError(f"No response generated by {host} for model {kwargs.get('model')}")
+        return ollama_response
+
+    def _submit(self, host, timeout, kwargs):
+        """Start a request on a daemon thread. Returns its future and its client."""
+        client = ollama.Client(host=host, timeout=max(1, math.ceil(timeout)))
+        future = Future()
+        def run():
+            try:
+                future.set_result(self._call(client, host, kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run, name='ollama', daemon=True).start()
+        return future, client
+
+    def _attempt(self, stage, kwargs, end_time):
+        """One attempt, possibly hedged, that gives up at end_time (time.perf_counter).
+        Returns the first successful response."""
+        # The request is dropped by the client when the attempt gives up
+        client_timeout = end_time - time.perf_counter()
+        primary_host, hedge_host = self._pick_hosts()
+        start_time = time.perf_counter()
+        future, client = self._submit(primary_host, client_timeout, kwargs)
+        pending = {future: 'primary'}
+        clients = [client]
+
+        hedge_delay = self._hedge_delay(stage)
+        first_error = None
+        try:
+            while pending:
+                remaining = end_time - time.perf_counter()
+                if remaining <= 0:
+                    break
+                # Wake up at the hedge point if a hedge can still be sent
+                timeout = remaining
+                if hedge_delay is not None:
+                    timeout = min(remaining, max(0.0, hedge_delay - (time.perf_counter() - start_time)))
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    role = pending.pop(future)
+                    try:
+                        ollama_response = future.result()
+                    except Exception as e:
+                        first_error = first_error or e
+                        continue
+                    with self._lock:
+                        self.stats[stage]['latencies'].append(time.perf_counter() - start_time)
+                    if role == 'hedge':
+                        self._count(stage, 'hedge_wins')
+                    return ollama_response
+
+                if hedge_delay is not None and not done:
+                    # The primary is slower than the hedge percentile; race a duplicate on another endpoint
+                    future, client = self._submit(hedge_host, client_timeout, kwargs)
+                    pending[future] = 'hedge'
+                    clients.append(client)
+                    self._count(stage, 'hedges')
+                    hedge_delay = None
+        finally:
+            # Closing drops the connection of a request still running (given up on or a lost hedge race)
+            for client in clients:
+                client.close()
+
+        if first_error is not None and not pending:
+            raise first_error
+        raise DeadlineExceededError(f"{stage} attempt did not complete within {client_timeout:.1f} seconds")
+
+    def _backoff(self, attempt):
+        """Exponential backoff with full jitter, capped at backoff_max."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def generate(self, stage, deadline = None, **kwargs):
+        """ollama.generate with the stage deadline, retries and hedging applied.
+        deadline optionally shortens the stage deadline for this call.
+        kwargs are passed straight through to ollama.Client.generate."""
+        self._count(stage, 'calls')
+        if deadline is None or deadline > self._deadline(stage):
+            deadline = self._deadline(stage)
+        end_time = time.perf_counter() + deadline
+        attempt_timeout = deadline / (self.max_retries + 1)
+        for attempt in range(self.max_retries + 1):
+            # A stalled attempt is given up after its share of the deadline, the last may use all that is left
+            attempt_end = end_time if attempt == self.max_retries else min(end_time, time.perf_counter() + attempt_timeout)
+            try:
+                return self._attempt(stage, kwargs, attempt_end)
+            except Exception as e:
+                if isinstance(e, (DeadlineExceededError, httpx.TimeoutException)):
+                    self._count(stage, 'timeouts')
+                else:
+                    self._count(stage, 'errors')
+                sleep_time = self._backoff(attempt)
+                out_of_time = time.perf_counter() + sleep_time >= end_time
+                if not _is_retryable(e) or attempt == self.max_retries or out_of_time:
+                    self._count(stage, 'failures')
+                    raise LLMCallError(f"{stage} call failed after {attempt + 1} attempt(s): {e}") from e
+                print(f"Retrying {stage} call in {sleep_time:.1f} seconds after error: {e}")
+                self._count(stage, 'retries')
+                time.sleep(sleep_time)
+
+    def tail_summary(self):
+        """A printable table of call latency percentiles and retry/hedge counts for each stage."""
+        header = (f"{'Stage':<14}{'Calls':>6}{'p50 (s)':>9}{'p95 (s)':>9}{'p99 (s)':>9}{'max (s)':>9}"
+                  f"{'Retries':>9}{'Timeouts':>10}{'Errors':>8}{'Hedges':>8}{'Hedge wins':>12}{'Failed':>8}")
+        lines = [header, "-"*len(header)]
+        for stage, stats in self.stats.items():
+            latencies = stats['latencies']
+            if latencies:
+                tail = "".join(f"{_percentile(latencies, p):>9.1f}" for p in (50, 95, 99)) + f"{max(latencies):>9.1f}"
+            else:
+                tail = f"{'-':>9}"*4
+            lines.append(
+                f"{stage:<14}{stats['calls']:>6}{tail}{stats['retries']:>9}{stats['timeouts']:>10}"
+                f"{stats['errors']:>8}{stats['hedges']:>8}{stats['hedge_wins']:>12}{stats['failures']:>8}"
+            )
+        return "\n".join(lines)
@@ -1,9 +1,11 @@
 import ollama
 
 class OllamaUtils:
-    def __init__(self):
+    def __init__(self, host=None):
+        """ host defaults to OLLAMA_HOST or localhost """
+        self.host = host
         try:
-            self.client = ollama.Client()
+            self.client = ollama.Client(host=host)
         except Exception as e:
             raise RuntimeError(f"Failed to initialize Ollama client: {e}")
         
@@ -46,6 +48,17 @@ class OllamaUtils:
         except Exception as e:
             return -1
                     
+    def validate_model(self, model_name, num_ctx=None) -> int:
+        """ Check the model exists and that num_ctx fits in its context window.
+        Returns the maximum context size of the model."""
+        if not self.model_exists(model_name):
+            raise KeyError(f"Model {model_name} does not exists" + (f" on {self.host}" if self.host else ""))
+
+        max_num_ctx = self.model_context_size(model_name)
+        if num_ctx is not None and max_num_ctx != -1 and num_ctx > max_num_ctx:
+            raise ValueError(f"ERROR: num-ctx {num_ctx} provided is larger than max_num_ctx {max_num_ctx} for {model_name}")
+        return max_num_ctx
+
     def model_base_model(self, model_name) -> int:
         """ Get the Base model for the given model name"""
         try:
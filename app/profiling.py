@@ -0,0 +1,114 @@
+import cProfile
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Number of allocation sites written to each stage's allocation report
+TOP_ALLOCATIONS = 25
+
+
+class StageProfiler:
+    """Opt-in per-stage CPU and memory profiling of the pipeline.
+
+    Each stage is run under cProfile and tracemalloc. For every stage a <nn>_<stage>.pstats
+    file (open with pstats or snakeviz) and a <nn>_<stage>_allocations.txt report of the
+    allocation sites that grew the most are written to output_dir. summary() separates
+    client-side CPU time from the time spent waiting on Ollama.
+
+    Notes:
+        cProfile only sees the thread that runs the stage, so concurrent chunk summaries
+        show up as waits on the worker threads; client CPU time (time.process_time)
+        covers all threads.
+        Ollama wait time is summed over concurrent calls and can exceed the stage wall time.
+    """
+    def __init__(self, output_dir, enabled = False):
+        self.output_dir = output_dir
+        self.enabled = enabled
+        self.results = []
+        self.current_stage = None
+        self._lock = threading.Lock()
+        self._waits = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Profile the enclosed block as the named stage. Does nothing unless enabled."""
+        if not self.enabled:
+            yield
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        file_prefix = os.path.join(self.output_dir, f"{len(self.results) + 1:02d}_{name}")
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        snapshot_before = tracemalloc.take_snapshot()
+        memory_before, _ = tracemalloc.get_traced_memory()
+
+        self.current_stage = name
+        self._waits[name] = 0.0
+        profiler = cProfile.Profile()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            cpu_seconds = time.process_time() - cpu_start
+            wall_seconds = time.perf_counter() - wall_start
+            self.current_stage = None
+
+            memory_after, memory_peak = tracemalloc.get_traced_memory()
+            snapshot_after = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+
+            profiler.dump_stats(f"{file_prefix}.pstats")
+            self._write_allocations(f"{file_prefix}_allocations.txt", name, snapshot_before, snapshot_after)
+            self.results.append({
+                'stage': name,
+                'wall_seconds': wall_seconds,
+                'cpu_seconds': cpu_seconds,
+                'ollama_wait_seconds': self._waits.pop(name),
+                'memory_net_mb': (memory_after - memory_before) / (1024*1024),
+                'memory_peak_mb': memory_peak / (1024*1024),
+            })
+
+    def record_wait(self, seconds):
+        """Add time spent waiting on an Ollama call (generate or embed) to the current stage."""
+        if not self.enabled or self.current_stage is None:
+            return
+        with self._lock:
+            self._waits[self.current_stage] = self._waits.get(self.current_stage, 0.0) + seconds
+
+    def _write_allocations(self, file_path, name, snapshot_before, snapshot_after):
+        # Leave out tracemalloc's own allocations
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        differences = snapshot_after.filter_traces(filters).compare_to(snapshot_before.filter_traces(filters), 'lineno')
+        top_current = snapshot_after.filter_traces(filters).statistics('lineno')
+        with open(file_path, 'w') as f:
+            f.write(f"== Top {TOP_ALLOCATIONS} allocation sites by growth during {name} ==\n")
+            for difference in differences[:TOP_ALLOCATIONS]:
+                f.write(f"{difference}\n")
+            f.write(f"\n== Top {TOP_ALLOCATIONS} allocation sites by size at the end of {name} ==\n")
+            for statistic in top_current[:TOP_ALLOCATIONS]:
+                f.write(f"{statistic}\n")
+
+    def summary(self):
+        """A printable table of wall, client CPU and Ollama wait time and memory per stage."""
+        header = (f"{'Stage':<14}{'Wall (s)':>10}{'Client CPU (s)':>16}{'Ollama wait (s)':>17}"
+                  f"{'Other (s)':>11}{'Net MB':>9}{'Peak MB':>9}")
+        lines = [header, "-"*len(header)]
+        for result in self.results:
+            # Time neither on the client CPU nor waiting on Ollama: disk, network to YouTube, sleeps
+            other = max(0.0, result['wall_seconds'] - result['cpu_seconds'] - result['ollama_wait_seconds'])
+            lines.append(
+                f"{result['stage']:<14}{result['wall_seconds']:>10.2f}{result['cpu_seconds']:>16.2f}"
+                f"{result['ollama_wait_seconds']:>17.2f}{other:>11.2f}"
+                f"{result['memory_net_mb']:>9.1f}{result['memory_peak_mb']:>9.1f}"
+            )
+        lines.append(f"Profiles written to {self.output_dir}")
+        return "\n".join(lines)
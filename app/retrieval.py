@@ -0,0 +1,64 @@
+import numpy as np
+from app.embeddings import embed_texts, DEFAULT_EMBEDDING_MODEL
+
+# A token is approximately 4 bytes
+BYTES_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    return len(text) // BYTES_PER_TOKEN + 1
+
+
+class ChunkSummaryRetriever:
+    """Picks a token-budgeted subset of the chunk summaries for a report section.
+
+    The summaries are embedded once. A selection always starts with the anchor chunks
+    (e.g. the opening chunk for the introduction, the closing chunk for the conclusion)
+    and is then filled with the most central summaries, i.e. those closest to the mean
+    of all summaries and so most representative of the main themes. Maximal marginal
+    relevance keeps near duplicate summaries from using up the budget.
+    """
+    def __init__(self, summaries, embedding_model=DEFAULT_EMBEDDING_MODEL, host=None, diversity=0.3, record_wait=None):
+        self.summaries = list(summaries)
+        self.diversity = diversity
+        self.token_counts = np.array([estimate_tokens(summary) for summary in self.summaries])
+        self.vectors = embed_texts(self.summaries, embedding_model, host, record_wait=record_wait)
+
+        centroid = self.vectors.mean(axis=0)
+        norm = np.linalg.norm(centroid)
+        self.centrality = self.vectors @ (centroid / norm) if norm > 0 else np.zeros(len(self.summaries))
+
+    def select(self, token_budget, anchors=()):
+        """Indexes (in transcript order) of the summaries that fit in token_budget.
+        The first anchor (or, without anchors, the most central summary) is always
+        selected, even if it alone is over the budget, so a section is never written
+        from nothing."""
+        count = len(self.summaries)
+        if self.token_counts.sum() <= token_budget:
+            return list(range(count))
+
+        first = anchors[0] % count if anchors else int(np.argmax(self.centrality))
+        selected = [first]
+        used = self.token_counts[first]
+        for anchor in anchors[1:]:
+            anchor = anchor % count
+            if anchor not in selected and used + self.token_counts[anchor] <= token_budget:
+                selected.append(anchor)
+                used += self.token_counts[anchor]
+
+        candidates = np.ones(count, dtype=bool)
+        candidates[selected] = False
+        candidates &= self.token_counts <= token_budget - used
+        while candidates.any():
+            if selected:
+                redundancy = (self.vectors @ self.vectors[selected].T).max(axis=1)
+            else:
+                redundancy = np.zeros(count)
+            scores = (1 - self.diversity) * self.centrality - self.diversity * redundancy
+            scores[~candidates] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            used += self.token_counts[best]
+            candidates[best] = False
+            candidates &= self.token_counts <= token_budget - used
+
+        return sorted(selected)
@@ -0,0 +1,537 @@
+import bisect
+import fcntl
+import hashlib
+import json
+import os
+import re
+from contextlib import contextmanager
+import numpy as np
+from app.embeddings import embed_texts, DEFAULT_EMBEDDING_MODEL
+from app.youtube_transcribe import transcript_segments_path
+
+# Report section files written by LexPodcastSummary, indexed alongside the chunk summaries
+SECTION_FILES = ('introduction.txt', 'main_body.txt', 'conclusion.txt', 'final_report.txt')
+
+# Passages are split on headings and paragraphs and merged up to this many characters
+MAX_PASSAGE_CHARS = 1500
+
+# Rows of the float16 embedding matrix converted to float32 at a time when scoring
+SCORE_BLOCK_ROWS = 65536
+
+# Pending postings are written as a new sorted segment once there are this many
+SEGMENT_FLUSH_POSTINGS = 1_000_000
+
+# The data files are rewritten without the rows of re-indexed episodes once more than
+# this fraction of the rows is deleted
+COMPACT_DELETED_FRACTION = 0.25
+
+# Segments are merged while the newer one is at least half the size of the one before it,
+# which keeps the number of segments logarithmic. Segments larger than this are not merged.
+MAX_MERGE_POSTINGS = 16_000_000
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i in is it its of on or "
+    "that the their them they this to was we were what which who will with you your".split()
+)
+
+def tokenize(text):
+    """Lower case alphanumeric terms with common stop words removed."""
+    return [term for term in TOKEN_PATTERN.findall(text.lower()) if term not in STOP_WORDS]
+
+def split_passages(text):
+    """Split markdown text into passages at headings and blank lines, merging small paragraphs."""
+    paragraphs = [paragraph.strip() for paragraph in re.split(r"\n\s*\n|\n(?=#)", text) if paragraph.strip()]
+    passages = []
+    current = ""
+    for paragraph in paragraphs:
+        if current and (paragraph.startswith('#') or len(current) + len(paragraph) > MAX_PASSAGE_CHARS):
+            passages.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+def _load_json(file_path, default):
+    if os.path.exists(file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return default
+
+def _save_json(file_path, data):
+    # Write then rename so an interrupted save never leaves a truncated index
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, file_path)
+
+def term_hash(term):
+    """Stable 64 bit id of a term, the postings store these rather than the terms."""
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def _rows(file_path, dtype, count, columns = None):
+    """Memory map the first count rows of an array file. Rows past count were appended by
+    an update that has not been committed (or did not finish) and are ignored."""
+    shape = (count, columns) if columns else (count,)
+    if count == 0:
+        return np.zeros(shape, dtype=dtype)
+    size = count * (columns or 1) * np.dtype(dtype).itemsize
+    if not os.path.exists(file_path) or os.path.getsize(file_path) < size:
+        raise ValueError(f"{file_path} is shorter than the index, rebuild the index")
+    return np.memmap(file_path, dtype=dtype, mode='r', shape=shape)
+
+def _truncate(file_path, size):
+    """Cut off anything an interrupted update appended past size bytes."""
+    if os.path.exists(file_path) and os.path.getsize(file_path) > size:
+        with open(file_path, 'r+b') as f:
+            f.truncate(size)
+
+def _chunk_files(episode_dir):
+    """The latest chunk_results_<index>_<uuid>.txt file for each chunk index."""
+    latest = {}
+    for filename in os.listdir(episode_dir):
+        if filename.startswith('chunk_results_') and filename.endswith('.txt'):
+            chunk_index = int(filename.split('_')[2].split('.')[0])
+            file_path = os.path.join(episode_dir, filename)
+            if chunk_index not in latest or os.path.getmtime(file_path) > os.path.getmtime(latest[chunk_index]):
+                latest[chunk_index] = file_path
+    return sorted(latest.items())
+
+def _timestamps(segments, span):
+    """Start and end time in seconds of a character span of the transcript."""
+    if not segments or span is None:
+        return None, None
+    offsets = [segment['offset'] for segment in segments]
+    first = segments[max(0, bisect.bisect_right(offsets, span[0]) - 1)]
+    last = segments[max(0, bisect.bisect_right(offsets, max(span[0], span[1] - 1)) - 1)]
+    return first['start'], last['start'] + last.get('duration', 0.0)
+
+def format_timestamp(seconds):
+    """Seconds as h:mm:ss"""
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class SummaryIndex:
+    """An incremental search index over the podcast_* results directories.
+
+    Passages (chunk summaries and report sections) are kept in an inverted index for
+    BM25 keyword scoring and, when an embedding model is configured, in a memory-mapped
+    float16 embedding matrix for semantic scoring. Chunk summary passages carry the
+    transcript timestamps of the chunk they summarize.
+
+    Everything that grows with the index is an append-only file, so adding an episode
+    costs the same however large the index is, and opening the index for a query only
+    parses meta.json and memory maps the arrays. Postings are written in segments sorted
+    by term hash; a query term is found with a binary search in each segment.
+    meta.json is the commit point: rows past its count were written by an update that
+    did not finish, they are ignored by queries and cut off by the next update.
+    Updates hold an exclusive lock on index_dir/lock.
+
+    The rows of a re-indexed episode are marked deleted and left out of the BM25 statistics.
+    Once more than COMPACT_DELETED_FRACTION of the rows are deleted, the data files are
+    rewritten without them as a new generation, which meta.json switches to on commit.
+
+    Files in index_dir:
+        meta.json              embedding model, dimension, passage counts, generation and the segments
+        g<n>.episodes.json     per episode, the file signature and its passage rows (read when updating)
+        g<n>.passages.jsonl    passage metadata (episode, kind, timestamps, ...) and text, one JSON object per line
+        g<n>.offsets.i64       byte offset of each passage in passages.jsonl
+        g<n>.lengths.i32       number of terms in each passage
+        g<n>.deleted.u8        1 for the passages of episodes that were re-indexed
+        g<n>.embeddings.f16    float16 embedding matrix, one row per passage
+        segment_<n>.*.npy      postings sorted by term hash: term hashes, passage ids and term frequencies
+    """
+    def __init__(self, index_dir, embedding_model=DEFAULT_EMBEDDING_MODEL, host=None, record_wait=None):
+        self.index_dir = index_dir
+        self.embedding_model = embedding_model
+        self.host = host
+        # Optional callable given the seconds spent waiting on each embedding request
+        self.record_wait = record_wait
+        os.makedirs(index_dir, exist_ok=True)
+        # Loaded while the index is being updated
+        self.episodes = None
+        self._load()
+
+    def _path(self, file_name):
+        return os.path.join(self.index_dir, file_name)
+
+    def _data_path(self, file_name, generation = None):
+        """Path of a data file of the current (or the given) generation."""
+        if generation is None:
+            generation = self.meta['generation']
+        return self._path(f"g{generation}.{file_name}")
+
+    def _load(self):
+        """Open the committed state of the index."""
+        self.meta = _load_json(self._path('meta.json'), {
+            'embedding_model': self.embedding_model, 'dim': 0, 'count': 0, 'live_count': 0, 'live_length': 0,
+            'text_bytes': 0, 'episodes': 0, 'generation': 0, 'segments': [], 'next_segment': 0,
+        })
+        if self.meta['count'] and self.meta['embedding_model'] != self.embedding_model:
+            raise ValueError(f"Index was built with embedding model {self.meta['embedding_model']}, not {self.embedding_model}")
+        self.meta['embedding_model'] = self.embedding_model
+
+        count = self.meta['count']
+        self.lengths = _rows(self._data_path('lengths.i32'), np.int32, count)
+        self.offsets = _rows(self._data_path('offsets.i64'), np.int64, count)
+        self.segments = [self._open_segment(segment['name']) for segment in self.meta['segments']]
+
+    def _open_segment(self, name):
+        return tuple(np.load(self._path(f"{name}.{part}.npy"), mmap_mode='r') for part in ('terms', 'ids', 'tfs'))
+
+    @contextmanager
+    def _locked(self):
+        """Hold the index lock and start from the committed state, repairing what an
+        interrupted update left behind."""
+        with open(self._path('lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._load()
+            self._repair()
+            episodes = _load_json(self._data_path('episodes.json'), {})
+            # episodes.json is saved before meta.json, drop episodes whose passages were not committed
+            self.episodes = {episode: entry for episode, entry in episodes.items()
+                             if entry['first'] + entry['count'] <= self.meta['count']}
+            self._pending = []
+            self._pending_postings = 0
+            self._changed = False
+            yield
+
+    def _repair(self):
+        count = self.meta['count']
+        _truncate(self._data_path('lengths.i32'), count * 4)
+        _truncate(self._data_path('offsets.i64'), count * 8)
+        _truncate(self._data_path('embeddings.f16'), count * self.meta['dim'] * 2)
+        _truncate(self._data_path('passages.jsonl'), self.meta['text_bytes'])
+        self._remove_uncommitted_files()
+
+    def _remove_uncommitted_files(self):
+        """Remove segments and data file generations that meta.json does not refer to."""
+        committed = {segment['name'] for segment in self.meta['segments']}
+        generation = f"g{self.meta['generation']}"
+        for filename in os.listdir(self.index_dir):
+            if ((filename.startswith('segment_') and filename.split('.')[0] not in committed)
+                    or (re.match(r"g\d+\.", filename) and filename.split('.')[0] != generation)):
+                os.remove(self._path(filename))
+
+    def save(self):
+        """Commit the episodes added since the index was locked."""
+        self._flush_segment()
+        deleted = np.ones(self.meta['count'], dtype=bool)
+        for entry in self.episodes.values():
+            deleted[entry['first']:entry['first'] + entry['count']] = False
+        if deleted.sum() > COMPACT_DELETED_FRACTION * len(deleted):
+            deleted = self._compact(deleted)
+
+        _save_json(self._data_path('episodes.json'), self.episodes)
+        tmp_path = self._data_path('deleted.u8.tmp')
+        deleted.astype(np.uint8).tofile(tmp_path)
+        os.replace(tmp_path, self._data_path('deleted.u8'))
+
+        # BM25 statistics of the passages that are not deleted
+        lengths = np.asarray(_rows(self._data_path('lengths.i32'), np.int32, self.meta['count']), dtype=np.int64)
+        self.meta['live_count'] = int((~deleted).sum())
+        self.meta['live_length'] = int(lengths[~deleted].sum())
+        self.meta['episodes'] = len(self.episodes)
+        _save_json(self._path('meta.json'), self.meta)
+
+        # Segments merged or compacted away and the previous generation are no longer referenced
+        self._remove_uncommitted_files()
+        self._load()
+
+    def _compact(self, deleted):
+        """Write the data files and segments without the deleted rows as a new generation.
+        Returns the (all False) deleted mask of the new generation."""
+        generation = self.meta['generation'] + 1
+        count = self.meta['count']
+        keep = np.flatnonzero(~deleted)
+        new_ids = np.full(count, -1, dtype=np.int64)
+        new_ids[keep] = np.arange(len(keep))
+
+        lengths = _rows(self._data_path('lengths.i32'), np.int32, count)
+        np.asarray(lengths[keep]).tofile(self._data_path('lengths.i32', generation))
+
+        offsets = _rows(self._data_path('offsets.i64'), np.int64, count)
+        new_offsets = np.zeros(len(keep), dtype=np.int64)
+        text_bytes = 0
+        with open(self._data_path('passages.jsonl'), 'rb') as source, \
+                open(self._data_path('passages.jsonl', generation), 'wb') as target:
+            for row, passage_id in enumerate(keep):
+                source.seek(int(offsets[passage_id]))
+                line = source.readline()
+                new_offsets[row] = text_bytes
+                target.write(line)
+                text_bytes += len(line)
+        new_offsets.tofile(self._data_path('offsets.i64', generation))
+
+        if self.meta['dim']:
+            matrix = _rows(self._data_path('embeddings.f16'), np.float16, count, self.meta['dim'])
+            with open(self._data_path('embeddings.f16', generation), 'wb') as f:
+                for start in range(0, len(keep), SCORE_BLOCK_ROWS):
+                    f.write(np.asarray(matrix[keep[start:start + SCORE_BLOCK_ROWS]]).tobytes())
+
+        segments = self.meta['segments']
+        self.meta['segments'] = []
+        for segment in segments:
+            terms, ids, tfs = (np.asarray(part) for part in self._open_segment(segment['name']))
+            live = new_ids[ids] >= 0
+            if live.any():
+                self._write_segment(terms[live], new_ids[ids[live]].astype(np.int32), tfs[live])
+
+        for entry in self.episodes.values():
+            entry['first'] = int(new_ids[entry['first']]) if entry['count'] else 0
+        self.meta.update(generation=generation, count=len(keep), text_bytes=text_bytes)
+        return np.zeros(len(keep), dtype=bool)
+
+    def _write_segment(self, terms, ids, tfs):
+        order = np.argsort(terms, kind='stable')
+        name = f"segment_{self.meta['next_segment']:06d}"
+        self.meta['next_segment'] += 1
+        for part, values in (('terms', terms), ('ids', ids), ('tfs', tfs)):
+            np.save(self._path(f"{name}.{part}.npy"), values[order])
+        self.meta['segments'].append({'name': name, 'postings': len(terms)})
+
+    def _flush_segment(self):
+        """Write the pending postings as a new segment and merge similar sized segments."""
+        if self._pending_postings:
+            self._write_segment(*(np.concatenate(parts) for parts in zip(*self._pending)))
+        self._pending = []
+        self._pending_postings = 0
+
+        segments = self.meta['segments']
+        while (len(segments) >= 2 and segments[-2]['postings'] <= 2 * segments[-1]['postings']
+               and segments[-2]['postings'] + segments[-1]['postings'] <= MAX_MERGE_POSTINGS):
+            older, newer = segments.pop(-2), segments.pop(-1)
+            arrays = [tuple(np.asarray(part) for part in self._open_segment(segment['name'])) for segment in (older, newer)]
+            self._write_segment(*(np.concatenate(parts) for parts in zip(*arrays)))
+
+    def _episode_signature(self, episode_dir):
+        """Modification times of the files an episode's passages are built from."""
+        signature = {}
+        for filename in os.listdir(episode_dir):
+            if filename.startswith('chunk_results_') or filename in SECTION_FILES:
+                signature[filename] = os.path.getmtime(os.path.join(episode_dir, filename))
+        return signature
+
+    def _episode_passages(self, episode_dir):
+        """Read the chunk summaries and report sections of an episode as passages."""
+        title_path = os.path.join(episode_dir, 'title.txt')
+        title = os.path.basename(os.path.normpath(episode_dir))
+        if os.path.exists(title_path):
+            with open(title_path, 'r', encoding='utf-8') as f:
+                title = f.read().strip()
+
+        chunk_offsets = _load_json(os.path.join(episode_dir, 'chunk_offsets.json'), None)
+        segments = _load_json(transcript_segments_path(os.path.join(episode_dir, 'transcript.txt')), None)
+
+        passages = []
+        for chunk_index, file_path in _chunk_files(episode_dir):
+            span = chunk_offsets[chunk_index - 1] if chunk_offsets and chunk_index <= len(chunk_offsets) else None
+            start_seconds, end_seconds = _timestamps(segments, span)
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            for text in split_passages(content):
+                passages.append({'kind': 'chunk', 'chunk_index': chunk_index,
+                                 'source': os.path.basename(file_path),
+                                 'start_seconds': start_seconds, 'end_seconds': end_seconds, 'text': text})
+
+        for section_file in SECTION_FILES:
+            file_path = os.path.join(episode_dir, section_file)
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            for text in split_passages(content):
+                passages.append({'kind': section_file[:-4], 'chunk_index': None, 'source': section_file,
+                                 'start_seconds': None, 'end_seconds': None, 'text': text})
+
+        for passage in passages:
+            passage['episode'] = os.path.abspath(episode_dir)
+            passage['title'] = title
+        return passages
+
+    def _add_episode(self, episode_dir):
+        """Append the passages of a new or changed episode. They are committed by save()."""
+        episode = os.path.abspath(episode_dir)
+        signature = self._episode_signature(episode_dir)
+        if not signature or self.episodes.get(episode, {}).get('signature') == signature:
+            return 0
+
+        passages = self._episode_passages(episode_dir)
+        vectors = None
+        if self.meta['embedding_model'] and passages:
+            vectors = embed_texts([passage['text'] for passage in passages], self.meta['embedding_model'], self.host,
+                                  record_wait=self.record_wait)
+            if self.meta['dim'] and vectors.shape[1] != self.meta['dim']:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index ({self.meta['dim']})")
+
+        first = self.meta['count']
+        lengths = np.zeros(len(passages), dtype=np.int32)
+        offsets = np.zeros(len(passages), dtype=np.int64)
+        terms, ids, tfs = [], [], []
+        lines = []
+        text_bytes = self.meta['text_bytes']
+        for row, passage in enumerate(passages):
+            passage_terms = tokenize(passage['text'])
+            term_counts = {}
+            for term in passage_terms:
+                term_counts[term] = term_counts.get(term, 0) + 1
+            terms.extend(term_hash(term) for term in term_counts)
+            ids.extend([first + row] * len(term_counts))
+            tfs.extend(term_counts.values())
+            lengths[row] = len(passage_terms)
+
+            line = (json.dumps(passage) + "\n").encode('utf-8')
+            offsets[row] = text_bytes
+            text_bytes += len(line)
+            lines.append(line)
+
+        # Rows past meta['count'] are ignored until save() commits them
+        if vectors is not None:
+            with open(self._data_path('embeddings.f16'), 'ab') as f:
+                f.write(vectors.astype(np.float16).tobytes())
+        with open(self._data_path('passages.jsonl'), 'ab') as f:
+            f.writelines(lines)
+        with open(self._data_path('lengths.i32'), 'ab') as f:
+            f.write(lengths.tobytes())
+        with open(self._data_path('offsets.i64'), 'ab') as f:
+            f.write(offsets.tobytes())
+
+        if vectors is not None:
+            self.meta['dim'] = vectors.shape[1]
+        self.meta['count'] += len(passages)
+        self.meta['text_bytes'] = text_bytes
+        self.episodes[episode] = {'signature': signature, 'first': first, 'count': len(passages)}
+        self._changed = True
+
+        if terms:
+            self._pending.append((np.array(terms, dtype=np.uint64), np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.int32)))
+            self._pending_postings += len(terms)
+        if self._pending_postings >= SEGMENT_FLUSH_POSTINGS:
+            self._flush_segment()
+        return len(passages)
+
+    def add_episode(self, episode_dir):
+        """Index (or re-index) a results directory. Returns the number of passages added,
+        0 when the episode is already up to date."""
+        return self.update_episodes([episode_dir])
+
+    def update(self, root_dir):
+        """Index every podcast_* results directory under root_dir that is new or has changed."""
+        episode_dirs = []
+        for name in sorted(os.listdir(root_dir)):
+            episode_dir = os.path.join(root_dir, name)
+            if name.startswith('podcast_') and os.path.isdir(episode_dir):
+                episode_dirs.append(episode_dir)
+        return self.update_episodes(episode_dirs)
+
+    def update_episodes(self, episode_dirs):
+        """Index the given results directories and commit them once.
+        If one fails the episodes before it are still committed."""
+        added = 0
+        with self._locked():
+            try:
+                for episode_dir in episode_dirs:
+                    added += self._add_episode(episode_dir)
+            finally:
+                if self._changed:
+                    self.save()
+        return added
+
+    def _embedding_matrix(self):
+        if not self.meta['embedding_model'] or not self.meta['dim'] or self.meta['count'] == 0:
+            return None
+        return _rows(self._data_path('embeddings.f16'), np.float16, self.meta['count'], self.meta['dim'])
+
+    def _deleted_mask(self):
+        count = self.meta['count']
+        deleted = np.zeros(count, dtype=bool)
+        file_path = self._data_path('deleted.u8')
+        if os.path.exists(file_path):
+            rows = min(count, os.path.getsize(file_path))
+            if rows:
+                deleted[:rows] = np.memmap(file_path, dtype=np.uint8, mode='r', shape=(rows,)) != 0
+        return deleted
+
+    def _postings(self, term):
+        """Passage ids and term frequencies of a term across all segments."""
+        term_id = np.uint64(term_hash(term))
+        ids, tfs = [], []
+        for segment_terms, segment_ids, segment_tfs in self.segments:
+            start = np.searchsorted(segment_terms, term_id, side='left')
+            end = np.searchsorted(segment_terms, term_id, side='right')
+            if end > start:
+                ids.append(segment_ids[start:end])
+                tfs.append(segment_tfs[start:end])
+        if not ids:
+            return None, None
+        return np.concatenate(ids).astype(np.int64), np.concatenate(tfs).astype(np.float32)
+
+    def _bm25_scores(self, query_terms, deleted):
+        """BM25 over the passages that are not deleted, the statistics leave the deleted ones out."""
+        scores = np.zeros(self.meta['count'], dtype=np.float32)
+        count = self.meta['live_count']
+        if count == 0:
+            return scores
+        average_length = max(self.meta['live_length'] / count, 1.0)
+        for term in set(query_terms):
+            ids, frequencies = self._postings(term)
+            if ids is None:
+                continue
+            live = ~deleted[ids]
+            ids, frequencies = ids[live], frequencies[live]
+            if len(ids) == 0:
+                continue
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[ids] / average_length)
+            idf = np.log(1 + (count - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * frequencies * (BM25_K1 + 1) / (frequencies + length_norm)
+        return scores
+
+    def _semantic_scores(self, query):
+        matrix = self._embedding_matrix()
+        if matrix is None:
+            return None
+        query_vector = embed_texts([query], self.meta['embedding_model'], self.host, record_wait=self.record_wait)[0]
+        scores = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], SCORE_BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            scores[start:start + len(block)] = block @ query_vector
+        return scores
+
+    def search(self, query, k=10, alpha=0.5):
+        """Top-k passages for the query across all indexed episodes.
+        alpha weighs semantic similarity against BM25 keyword score (both scaled to 0..1)."""
+        if self.meta['count'] == 0:
+            return []
+        deleted = self._deleted_mask()
+        scores = self._bm25_scores(tokenize(query), deleted)
+        if scores.max() > 0:
+            scores /= scores.max()
+        semantic = self._semantic_scores(query) if alpha > 0 else None
+        if semantic is not None:
+            scores = alpha * np.clip(semantic, 0, None) + (1 - alpha) * scores
+        scores[deleted] = -np.inf
+
+        k = min(k, int((~deleted).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[scores[top] > 0]
+
+        results = []
+        with open(self._data_path('passages.jsonl'), 'rb') as f:
+            for passage_id in top:
+                f.seek(int(self.offsets[passage_id]))
+                result = json.loads(f.readline())
+                result['score'] = float(scores[passage_id])
+                results.append(result)
+        return results
@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+
+# Ollama reports all durations in nanoseconds
+NANOSECONDS_PER_SECOND = 1_000_000_000
+
+class ThroughputTracker:
+    """Accumulates token and timing statistics for each pipeline stage.
+
+    A stage is one of the pipeline steps (e.g. 'map', 'introduction', 'main_body',
+    'conclusion', 'final'). Statistics are keyed by stage and model so that different
+    models used for the same stage can be compared across runs.
+    """
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.stats = {}
+        self._lock = threading.Lock()
+        if file_path is not None and os.path.exists(file_path):
+            with open(file_path, 'r') as f:
+                self.stats = json.load(f)
+
+    def _key(self, stage, model_name):
+        return f"{stage}|{model_name}"
+
+    def record(self, stage, model_name, ollama_response, wall_time):
+        """Record a single ollama.generate call for the given stage."""
+        key = self._key(stage, model_name)
+        with self._lock:
+            return self._record(key, stage, model_name, ollama_response, wall_time)
+
+    def _record(self, key, stage, model_name, ollama_response, wall_time):
+        entry = self.stats.setdefault(key, {
+            'stage': stage,
+            'model_name': model_name,
+            'calls': 0,
+            'prompt_tokens': 0,
+            'prompt_eval_seconds': 0.0,
+            'eval_tokens': 0,
+            'eval_seconds': 0.0,
+            'load_seconds': 0.0,
+            'wall_seconds': 0.0,
+        })
+        entry['calls'] += 1
+        entry['prompt_tokens'] += ollama_response.get('prompt_eval_count') or 0
+        entry['prompt_eval_seconds'] += (ollama_response.get('prompt_eval_duration') or 0) / NANOSECONDS_PER_SECOND
+        entry['eval_tokens'] += ollama_response.get('eval_count') or 0
+        entry['eval_seconds'] += (ollama_response.get('eval_duration') or 0) / NANOSECONDS_PER_SECOND
+        entry['load_seconds'] += (ollama_response.get('load_duration') or 0) / NANOSECONDS_PER_SECOND
+        entry['wall_seconds'] += wall_time
+        return entry
+
+    def stage_entries(self, stage):
+        """All entries recorded for a stage, one per model."""
+        return [entry for entry in self.stats.values() if entry['stage'] == stage]
+
+    def tokens_per_second(self, stage, model_name):
+        """Generation speed (eval tokens/sec) measured for a stage and model, or None."""
+        entry = self.stats.get(self._key(stage, model_name))
+        if entry is None or entry['eval_seconds'] <= 0:
+            return None
+        return entry['eval_tokens'] / entry['eval_seconds']
+
+    def prompt_tokens_per_second(self, stage, model_name):
+        """Prompt evaluation speed (prompt tokens/sec) measured for a stage and model, or None."""
+        entry = self.stats.get(self._key(stage, model_name))
+        if entry is None or entry['prompt_eval_seconds'] <= 0:
+            return None
+        return entry['prompt_tokens'] / entry['prompt_eval_seconds']
+
+    def model_tokens_per_second(self, model_name):
+        """Generation speed measured for a model over all stages, or None."""
+        entries = [entry for entry in self.stats.values() if entry['model_name'] == model_name]
+        eval_seconds = sum(entry['eval_seconds'] for entry in entries)
+        if eval_seconds <= 0:
+            return None
+        return sum(entry['eval_tokens'] for entry in entries) / eval_seconds
+
+    def model_prompt_tokens_per_second(self, model_name):
+        """Prompt evaluation speed measured for a model over all stages, or None."""
+        entries = [entry for entry in self.stats.values() if entry['model_name'] == model_name]
+        prompt_eval_seconds = sum(entry['prompt_eval_seconds'] for entry in entries)
+        if prompt_eval_seconds <= 0:
+            return None
+        return sum(entry['prompt_tokens'] for entry in entries) / prompt_eval_seconds
+
+    def save(self):
+        if self.file_path is None:
+            return
+        with self._lock:
+            with open(self.file_path, 'w') as f:
+                json.dump(self.stats, f, indent=4)
+
+    def summary(self):
+        """A printable table of the throughput for each stage and model."""
+        header = f"{'Stage':<14}{'Model':<24}{'Calls':>6}{'Prompt tok':>12}{'Prompt t/s':>12}{'Gen tok':>10}{'Gen t/s':>10}{'Wall (s)':>10}"
+        lines = [header, "-"*len(header)]
+        for entry in self.stats.values():
+            prompt_tps = entry['prompt_tokens'] / entry['prompt_eval_seconds'] if entry['prompt_eval_seconds'] > 0 else 0.0
+            eval_tps = entry['eval_tokens'] / entry['eval_seconds'] if entry['eval_seconds'] > 0 else 0.0
+            lines.append(
+                f"{entry['stage']:<14}{entry['model_name']:<24}{entry['calls']:>6}"
+                f"{entry['prompt_tokens']:>12}{prompt_tps:>12.1f}"
+                f"{entry['eval_tokens']:>10}{eval_tps:>10.1f}{entry['wall_seconds']:>10.1f}"
+            )
+        return "\n".join(lines)
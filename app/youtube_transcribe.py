@@ -1,4 +1,6 @@
 import argparse
+import json
+import os
 from youtube_transcript_api import YouTubeTranscriptApi
 import re
 import requests
@@ -20,6 +22,11 @@ def extract_video_id(youtube_url):
         raise ValueError("Could not extract video ID from URL. Please provide a valid YouTube URL.")
 
 
+def transcript_segments_path(transcript_file_path):
+    """ The file holding the start time and character offset of each transcript segment """
+    return os.path.join(os.path.dirname(transcript_file_path), 'transcript_segments.json')
+
+
 def get_transcript(video_id, output_file=None, language='en'):
 
     try:
@@ -27,17 +34,25 @@ def get_transcript(video_id, output_file=None, language='en'):
         transcript_list = YouTubeTranscriptApi.get_transcript(video_id, languages=[language])
         
         # Combine all transcript pieces into one text
+        # keeping the character offset of each piece so text can be linked back to a timestamp
         transcript_text = ""
+        segments = []
         for entry in transcript_list:
+            segments.append({'offset': len(transcript_text), 'start': entry['start'], 'duration': entry.get('duration', 0.0)})
             transcript_text += entry['text'] + " "
         
         # Clean up the text
+        leading_whitespace = len(transcript_text) - len(transcript_text.lstrip())
         transcript_text = transcript_text.strip()
+        for segment in segments:
+            segment['offset'] = max(0, segment['offset'] - leading_whitespace)
         
         # Save to file if specified
         if output_file:
             with open(output_file, 'w', encoding='utf-8') as f:
                 f.write(transcript_text)
+            with open(transcript_segments_path(output_file), 'w', encoding='utf-8') as f:
+                json.dump(segments, f)
             
         return transcript_text
     
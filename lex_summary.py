@@ -3,6 +3,7 @@ import os
 import argparse
 from app.lex_podcast_summary import LexPodcastSummary
 from app.youtube_transcribe import extract_video_id
+from app.embeddings import DEFAULT_EMBEDDING_MODEL
 
 def main():
     parser = argparse.ArgumentParser(description='Lex podcast URL and working directory.')
@@ -10,6 +11,41 @@ def main():
     parser.add_argument('podcast_url', type=str, help='URL of the podcast')
     parser.add_argument('work_dir', nargs='?', default=None, type=str,
                         help='Directory to save podcast files (default is current directory)')
+    parser.add_argument('--map-model', default=None, type=str,
+                        help='Model used to summarize each transcript chunk (e.g. a small fast 8B model)')
+    parser.add_argument('--map-num-ctx', default=None, type=int,
+                        help='Context window size for the chunk summary model')
+    parser.add_argument('--section-model', default=None, type=str,
+                        help='Model used to write the introduction, main body and conclusion')
+    parser.add_argument('--final-model', default=None, type=str,
+                        help='Model used to write the final report')
+    parser.add_argument('--ollama-host', action='append', default=None, type=str,
+                        help='Ollama endpoint, repeat to spread and hedge requests across servers')
+    parser.add_argument('--call-timeout', default=None, type=float,
+                        help='Seconds an LLM call may take, including its retries')
+    parser.add_argument('--max-retries', default=None, type=int,
+                        help='Retries with exponential backoff after a timeout or server error')
+    parser.add_argument('--hedge-percentile', default=None, type=float,
+                        help='Send a duplicate request to another host once a call is slower than this latency percentile')
+    parser.add_argument('--section-token-budget', default=None, type=int,
+                        help='Tokens of chunk summaries sent to the introduction and conclusion, 0 sends them all')
+    parser.add_argument('--concurrency', default=None, type=str,
+                        help="Number of chunks summarized at once, or 'auto' for the setting found by python -m app.autotune")
+    parser.add_argument('--adaptive-concurrency', action='store_true',
+                        help='Adjust the concurrency during the run when throughput drops')
+    parser.add_argument('--max-concurrency', default=None, type=int,
+                        help='Upper limit for the adaptive concurrency')
+    parser.add_argument('--deadline-minutes', default=None, type=float,
+                        help='Plan the length of every LLM response so the report is finished within this many minutes')
+    parser.add_argument('--token-budget', default=None, type=int,
+                        help='Total number of tokens the LLM may generate for the report (exceeded only if it is less than the shortest responses of all the calls)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile each pipeline stage with cProfile and tracemalloc, reports go to <results dir>/profile')
+    parser.add_argument('--index-dir', default=None, type=str,
+                        help='Add the summaries to the search index in this directory (see summary_search.py)')
+    parser.add_argument('--embedding-model', default=None, type=str,
+                        help='Ollama embedding model for the search index and for picking the summaries sent to the '
+                             'introduction and conclusion, "none" for keyword search only and every summary in each section')
 
     args = parser.parse_args()
 
@@ -49,7 +85,38 @@ def main():
         'text_chunk_overlay_size': 100,
     }
 
+    # The hosts come first so the models are validated on them
+    lex_podcast_summary.config_llm_client(hosts=args.ollama_host,
+                                          default_deadline=args.call_timeout,
+                                          max_retries=args.max_retries,
+                                          hedge_percentile=args.hedge_percentile)
     lex_podcast_summary.config(**config_params)
+    lex_podcast_summary.config_concurrency(concurrency=args.concurrency,
+                                           adaptive=args.adaptive_concurrency,
+                                           max_concurrency=args.max_concurrency)
+    if args.deadline_minutes is not None or args.token_budget is not None:
+        deadline_seconds = args.deadline_minutes * 60 if args.deadline_minutes is not None else None
+        lex_podcast_summary.config_budget(deadline_seconds=deadline_seconds, token_budget=args.token_budget)
+    if args.embedding_model and args.embedding_model.lower() == 'none':
+        # No embedding model to pick summaries with, send them all
+        lex_podcast_summary.config_retrieval(token_budget=0)
+    elif args.section_token_budget is not None or args.embedding_model:
+        lex_podcast_summary.config_retrieval(token_budget=args.section_token_budget, embedding_model=args.embedding_model)
+    if args.profile:
+        lex_podcast_summary.config_profiling(True)
+    if args.index_dir:
+        embedding_model = args.embedding_model or DEFAULT_EMBEDDING_MODEL
+        lex_podcast_summary.config_index(args.index_dir,
+                                         embedding_model=None if embedding_model.lower() == 'none' else embedding_model)
+
+    if args.map_model or args.map_num_ctx:
+        lex_podcast_summary.config_stage('map', model_name=args.map_model, num_cxt=args.map_num_ctx)
+    if args.section_model:
+        for stage in ('introduction', 'main_body', 'conclusion'):
+            lex_podcast_summary.config_stage(stage, model_name=args.section_model)
+    if args.final_model:
+        lex_podcast_summary.config_stage('final', model_name=args.final_model)
+
     lex_podcast_summary.create_summary_report()
     
 
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import argparse
+import time
+from app.summary_index import SummaryIndex, format_timestamp
+from app.embeddings import DEFAULT_EMBEDDING_MODEL
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query the search index over generated podcast summaries.')
+    parser.add_argument('--index-dir', default='summary_index', type=str,
+                        help='Directory holding the search index (default is ./summary_index)')
+    parser.add_argument('--embedding-model', default=DEFAULT_EMBEDDING_MODEL, type=str,
+                        help=f'Ollama embedding model (default is {DEFAULT_EMBEDDING_MODEL}), use "none" for keyword search only')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Index new or changed podcast_* directories')
+    build_parser.add_argument('root_dir', nargs='?', default='.', type=str,
+                              help='Directory containing the podcast_* results directories (default is current directory)')
+
+    query_parser = subparsers.add_parser('query', help='Search the index')
+    query_parser.add_argument('query', type=str, help='Search text')
+    query_parser.add_argument('-k', default=10, type=int, help='Number of passages to return')
+    query_parser.add_argument('--alpha', default=0.5, type=float,
+                              help='Weight of semantic similarity against keyword score (0 is keyword only)')
+
+    args = parser.parse_args()
+    embedding_model = None if args.embedding_model.lower() == 'none' else args.embedding_model
+    # Opening the index is part of the query latency
+    start_time = time.perf_counter()
+    summary_index = SummaryIndex(args.index_dir, embedding_model=embedding_model)
+
+    if args.command == 'build':
+        added = summary_index.update(args.root_dir)
+        print(f"Indexed {added} new passages in {time.perf_counter() - start_time:.1f} seconds. "
+              f"The index has {summary_index.meta['episodes']} episodes.")
+        return
+
+    results = summary_index.search(args.query, k=args.k, alpha=args.alpha)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    for rank, result in enumerate(results, start=1):
+        timestamps = f"{format_timestamp(result['start_seconds'])}-{format_timestamp(result['end_seconds'])}"
+        print(f"{rank}. [{result['score']:.3f}] {result['title']} | {result['kind']} | {timestamps}")
+        print(f"   {result['episode']}/{result['source']}")
+        print("   " + result['text'][:300].replace("\n", " "))
+        print()
+    print(f"{len(results)} results in {elapsed_ms:.1f} ms (including opening the index)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import time
+import pytest
+from app.budget_planner import (GenerationBudgetPlanner, MIN_NUM_PREDICT, CALL_TIME_MARGIN,
+                                DEFAULT_TOKENS_PER_SECOND, DEFAULT_PROMPT_TOKENS_PER_SECOND)
+from app.throughput import ThroughputTracker
+
+MODEL = 'llama3.1'
+STAGES = ['introduction', 'main_body', 'conclusion', 'final']
+
+def run_episode(planner, chunk_count, num_ctx = 1_000_000):
+    """Plan every call of an episode, each generating all its num_predict. Returns the planned num_predicts."""
+    planned = {}
+    planner.start(chunk_count)
+    for stage in ['map'] * chunk_count + STAGES:
+        if planner.should_skip(stage, MODEL, 1000):
+            planner.skip(stage)
+            continue
+        num_predict = planner.stage_options(stage, MODEL, 1000, num_ctx)['num_predict']
+        planned.setdefault(stage, []).append(num_predict)
+        planner.record(stage, {'eval_count': num_predict})
+    return planned
+
+def test_chunks_get_equal_allotments_and_the_total_stays_within_the_budget():
+    planner = GenerationBudgetPlanner(ThroughputTracker(), token_budget=20000)
+    planned = run_episode(planner, 10)
+    assert max(planned['map']) - min(planned['map']) <= 1
+    assert planner.tokens_used <= 20000
+    # The spare tokens are shared in proportion to STAGE_SHARES
+    assert sum(planned['map']) == pytest.approx(0.40 * 20000, rel=0.1)
+    assert planned['final'][0] == pytest.approx(0.26 * 20000, rel=0.1)
+
+def test_the_minimums_are_reserved_for_the_calls_to_come():
+    budget = sum(MIN_NUM_PREDICT.values()) + 9 * MIN_NUM_PREDICT['map'] + 100
+    planner = GenerationBudgetPlanner(ThroughputTracker(), token_budget=budget)
+    planned = run_episode(planner, 10)
+    assert 'final' in planned
+    assert planner.tokens_used <= budget
+    for stage, num_predicts in planned.items():
+        assert min(num_predicts) >= MIN_NUM_PREDICT[stage]
+
+def test_final_is_skipped_when_the_budget_is_used_up(capsys):
+    budget = sum(MIN_NUM_PREDICT[stage] for stage in STAGES if stage != 'final') + 10 * MIN_NUM_PREDICT['map']
+    planner = GenerationBudgetPlanner(ThroughputTracker(), token_budget=budget)
+    planned = run_episode(planner, 10)
+    assert 'budget will be exceeded' in capsys.readouterr().out
+    assert 'final' not in planned
+    assert planner.tokens_used <= budget
+
+def test_num_predict_fits_in_num_ctx():
+    planner = GenerationBudgetPlanner(ThroughputTracker(), token_budget=100000)
+    planner.start(2)
+    assert planner.stage_options('final', MODEL, 1000, 2048)['num_predict'] == 2048 - 1250
+
+def test_call_deadline_leaves_time_for_the_shortest_call():
+    planner = GenerationBudgetPlanner(ThroughputTracker(), deadline_seconds=3600)
+    planner.start(10)
+    assert planner.call_deadline('map', MODEL, 1000) == pytest.approx(3600, abs=1)
+
+    planner.start(10, start_time=time.perf_counter() - 4000)
+    shortest_call = 5000 / DEFAULT_PROMPT_TOKENS_PER_SECOND + MIN_NUM_PREDICT['main_body'] / DEFAULT_TOKENS_PER_SECOND
+    assert planner.call_deadline('main_body', MODEL, 5000) == pytest.approx(CALL_TIME_MARGIN * shortest_call)
+    assert planner.stage_options('main_body', MODEL, 5000, 8192)['num_predict'] == MIN_NUM_PREDICT['main_body']
+    assert planner.should_skip('final', MODEL, 5000)
+
+def test_no_deadline_without_a_deadline():
+    planner = GenerationBudgetPlanner(ThroughputTracker(), token_budget=1000)
+    planner.start(1)
+    assert planner.call_deadline('map', MODEL, 1000) is None
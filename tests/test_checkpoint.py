@@ -0,0 +1,75 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app.checkpoint import (set_checkpoint_directory, checkpoint, load_checkpoints, reset_checkpoint_counter,
+                            reserve_checkpoint_counter, pinned_checkpoint_counter)
+
+CHUNKS = 8
+
+# Chunks that raise, standing in for an interrupted run
+FAILING = set()
+
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path):
+    set_checkpoint_directory(str(tmp_path))
+    reset_checkpoint_counter()
+    yield tmp_path
+    set_checkpoint_directory(None)
+    reset_checkpoint_counter()
+
+@checkpoint
+def summarize_chunk(chunk_index):
+    # Later chunks finish first so checkpoints are saved out of order
+    time.sleep((CHUNKS - chunk_index) * 0.01)
+    if chunk_index in FAILING:
+        raise RuntimeError(f"chunk {chunk_index} failed")
+    return chunk_index
+
+@checkpoint
+def introduction():
+    return 'introduction'
+
+def run_sequentially():
+    reset_checkpoint_counter()
+    for chunk_index in range(CHUNKS):
+        summarize_chunk(chunk_index)
+    introduction()
+
+def run_concurrently(failing = ()):
+    """The way LexPodcastSummary._summarize_chunks runs the chunks. Returns the chunks that failed."""
+    FAILING.clear()
+    FAILING.update(failing)
+    reset_checkpoint_counter()
+    counters = [reserve_checkpoint_counter() for _ in range(CHUNKS)]
+
+    def summarize(chunk_index, counter):
+        with pinned_checkpoint_counter(counter):
+            return summarize_chunk(chunk_index)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(summarize, chunk_index, counter) for chunk_index, counter in enumerate(counters)]
+    failed = [chunk_index for chunk_index, future in enumerate(futures) if future.exception() is not None]
+    if not failed:
+        introduction()
+    return failed
+
+
+def test_concurrent_run_matches_sequential_names(checkpoint_dir):
+    run_sequentially()
+    sequential = load_checkpoints()
+    (checkpoint_dir / 'checkpoints.json').unlink()
+
+    assert run_concurrently() == []
+    assert load_checkpoints() == sequential
+
+def test_resumed_concurrent_run_matches_sequential_names(checkpoint_dir):
+    run_sequentially()
+    sequential = load_checkpoints()
+    (checkpoint_dir / 'checkpoints.json').unlink()
+
+    assert run_concurrently(failing=(2, 5)) == [2, 5]
+    assert len(load_checkpoints()) == CHUNKS - 2
+
+    # Only the failed chunks run again and the calls after the map stage keep their names
+    assert run_concurrently() == []
+    assert load_checkpoints() == sequential
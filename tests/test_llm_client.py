@@ -0,0 +1,121 @@
+import os
+import subprocess
+import sys
+import time
+import pytest
+from app.fake_ollama_server import start_fake_server
+from app.llm_client import ResilientOllama, LLMCallError, EmptyResponseError, DeadlineExceededError, _percentile
+
+MODEL = 'llama3.3:latest'
+
+@pytest.fixture
+def servers():
+    started = []
+    def start(**config):
+        server = start_fake_server(**config)
+        started.append(server)
+        return server
+    yield start
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+def _url(server):
+    return f"http://127.0.0.1:{server.server_port}"
+
+def _generate(llm, stage='map'):
+    return llm.generate(stage, model=MODEL, prompt='Summarize this.', options={'num_predict': 4})
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 11))
+    assert _percentile(values, 50) == 5
+    assert _percentile(values, 90) == 9
+    assert _percentile(values, 95) == 10
+    assert _percentile(values, 0) == 1
+    assert _percentile([3.0], 99) == 3.0
+
+def test_server_errors_are_retried(servers):
+    server = servers(error_rate=0.5, seed=1)
+    llm = ResilientOllama([_url(server)], max_retries=10, backoff_base=0.01)
+    for _ in range(5):
+        assert _generate(llm)['response']
+    assert llm.stats['map']['retries'] > 0
+    assert llm.stats['map']['failures'] == 0
+
+def test_gives_up_after_max_retries(servers):
+    server = servers(error_rate=1.0)
+    llm = ResilientOllama([_url(server)], max_retries=2, backoff_base=0.01)
+    with pytest.raises(LLMCallError):
+        _generate(llm)
+    assert server.config.requests == 3
+    assert llm.stats['map']['failures'] == 1
+
+def test_empty_response_is_an_error(servers):
+    server = servers(empty_rate=1.0)
+    llm = ResilientOllama([_url(server)], max_retries=1, backoff_base=0.01)
+    with pytest.raises(LLMCallError) as error:
+        _generate(llm)
+    assert isinstance(error.value.__cause__, EmptyResponseError)
+    assert server.config.requests == 2
+
+def test_deadline_covers_all_retries(servers):
+    server = servers(stall_rate=1.0, stall_seconds=2.0)
+    llm = ResilientOllama([_url(server)], deadlines={'map': 0.5}, max_retries=3, backoff_base=0.01)
+    start_time = time.perf_counter()
+    with pytest.raises(LLMCallError) as error:
+        _generate(llm)
+    assert time.perf_counter() - start_time < 1.0
+    assert isinstance(error.value.__cause__, DeadlineExceededError)
+    assert llm.stats['map']['timeouts'] >= 2
+    assert llm.stats['map']['timeouts'] == llm.stats['map']['retries'] + 1
+
+def test_stalled_attempt_is_retried_within_the_deadline(servers):
+    server = servers(stall_first=1, stall_seconds=5.0)
+    llm = ResilientOllama([_url(server)], deadlines={'map': 2.0}, max_retries=1, backoff_base=0.01)
+    start_time = time.perf_counter()
+    assert _generate(llm)['response']
+    # The first attempt is dropped after half the deadline
+    assert time.perf_counter() - start_time < 1.8
+    assert llm.stats['map']['timeouts'] == 1
+    assert llm.stats['map']['retries'] == 1
+
+def test_slow_call_is_hedged_on_another_host(servers):
+    fast = servers()
+    slow = servers()
+    llm = ResilientOllama([_url(slow), _url(fast)], deadlines={'map': 10}, hedge_percentile=95, hedge_min_samples=4)
+    for _ in range(4):
+        _generate(llm)
+
+    # The next call goes to the slow host first and is hedged on the fast one
+    slow.config.stall_rate = 1.0
+    slow.config.stall_seconds = 2.0
+    start_time = time.perf_counter()
+    assert _generate(llm)['response']
+    assert time.perf_counter() - start_time < 1.5
+    assert llm.stats['map']['hedges'] == 1
+    assert llm.stats['map']['hedge_wins'] == 1
+
+def test_call_deadline_shortens_the_stage_deadline(servers):
+    server = servers(stall_rate=1.0, stall_seconds=2.0)
+    llm = ResilientOllama([_url(server)], deadlines={'map': 30}, max_retries=3, backoff_base=0.01)
+    start_time = time.perf_counter()
+    with pytest.raises(LLMCallError):
+        llm.generate('map', deadline=0.5, model=MODEL, prompt='Summarize this.', options={'num_predict': 4})
+    assert time.perf_counter() - start_time < 1.0
+
+def test_process_exits_without_waiting_for_a_stalled_request(servers):
+    server = servers(stall_rate=1.0, stall_seconds=30.0)
+    # The call is interrupted (as by Ctrl-C) a second into a long deadline
+    script = (
+        "import signal, sys\n"
+        "from app.llm_client import ResilientOllama\n"
+        "signal.signal(signal.SIGALRM, lambda *args: sys.exit(0))\n"
+        "signal.alarm(1)\n"
+        f"llm = ResilientOllama(['{_url(server)}'], deadlines={{'map': 60}}, max_retries=0)\n"
+        f"llm.generate('map', model='{MODEL}', prompt='Summarize this.')\n"
+    )
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, '-c', script], check=True, timeout=40,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert time.perf_counter() - start_time < 10
@@ -0,0 +1,26 @@
+import pytest
+from app.fake_ollama_server import start_fake_server
+from app.retrieval import ChunkSummaryRetriever
+
+@pytest.fixture(scope='module')
+def host():
+    server = start_fake_server()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+def test_select_keeps_the_anchor_when_it_alone_is_over_budget(host):
+    summaries = [f"summary {index} " * 50 for index in range(6)]
+    retriever = ChunkSummaryRetriever(summaries, 'nomic-embed-text', host)
+    assert retriever.select(10, anchors=(0,)) == [0]
+    assert retriever.select(10, anchors=(-1,)) == [5]
+    assert len(retriever.select(10)) == 1
+    assert retriever.select(10**6, anchors=(0,)) == list(range(6))
+
+def test_select_fills_the_budget_after_the_anchor(host):
+    summaries = [f"summary {index} " * 10 for index in range(10)]
+    retriever = ChunkSummaryRetriever(summaries, 'nomic-embed-text', host)
+    budget = int(retriever.token_counts[:4].sum())
+    selected = retriever.select(budget, anchors=(-1,))
+    assert 9 in selected and len(selected) == 4
+    assert retriever.token_counts[selected].sum() <= budget
@@ -0,0 +1,187 @@
+import json
+import multiprocessing
+import os
+import random
+import time
+import numpy as np
+import pytest
+from app.fake_ollama_server import start_fake_server
+from app.summary_index import SummaryIndex, COMPACT_DELETED_FRACTION
+
+WORDS = [f"word{index}" for index in range(300)]
+
+@pytest.fixture(scope='module')
+def host():
+    server = start_fake_server()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+def write_episode(root, name, seed, chunks = 3, extra = ""):
+    """A results directory with chunk summaries and an introduction of random words."""
+    rng = random.Random(seed)
+    episode_dir = os.path.join(root, f"podcast_{name}")
+    os.makedirs(episode_dir, exist_ok=True)
+    with open(os.path.join(episode_dir, 'title.txt'), 'w') as f:
+        f.write(name)
+    for chunk_index in range(1, chunks + 1):
+        paragraphs = [' '.join(rng.choices(WORDS, k=rng.randint(20, 60))) for _ in range(3)]
+        with open(os.path.join(episode_dir, f"chunk_results_{chunk_index}_x.txt"), 'w') as f:
+            f.write("\n\n".join(paragraphs))
+    with open(os.path.join(episode_dir, 'introduction.txt'), 'w') as f:
+        f.write(' '.join(rng.choices(WORDS, k=40)) + extra)
+    # The index notices changes by modification time
+    os.utime(episode_dir, None)
+    time.sleep(0.01)
+    return episode_dir
+
+def results(summary_index, query, alpha = 0.0, k = 5):
+    return [(result['episode'], result['source'], result['text'], round(result['score'], 5))
+            for result in summary_index.search(query, k=k, alpha=alpha)]
+
+def fresh_index(tmp_path, root, host):
+    summary_index = SummaryIndex(str(tmp_path / 'fresh'), host=host)
+    summary_index.update(str(root))
+    return summary_index
+
+def assert_embeddings_line_up(summary_index):
+    """Every passage is its own best semantic match, so embedding row i belongs to passage i."""
+    for passage_id in range(0, summary_index.meta['count'], 5):
+        with open(summary_index._data_path('passages.jsonl'), 'rb') as f:
+            f.seek(int(summary_index.offsets[passage_id]))
+            text = f.readline()
+        if summary_index._deleted_mask()[passage_id]:
+            continue
+        top = summary_index.search(json.loads(text)['text'], k=1, alpha=1.0)[0]
+        assert top['score'] == pytest.approx(1.0, abs=1e-2)
+
+
+def test_search_across_episodes(tmp_path, host):
+    root = tmp_path / 'results'
+    for seed in range(3):
+        write_episode(root, f"episode{seed}", seed)
+    summary_index = SummaryIndex(str(tmp_path / 'index'), host=host)
+    added = summary_index.update(str(root))
+    assert added == summary_index.meta['count'] == summary_index.meta['live_count']
+    assert summary_index.meta['episodes'] == 3
+
+    write_episode(root, 'unique', 10, extra=" zebra unicorn")
+    assert summary_index.update(str(root)) > 0
+    top = summary_index.search('zebra unicorn', k=1, alpha=0.0)[0]
+    assert top['episode'].endswith('podcast_unique') and top['source'] == 'introduction.txt'
+    assert_embeddings_line_up(summary_index)
+
+    # Nothing changed, nothing is added
+    assert summary_index.update(str(root)) == 0
+
+def test_reindexed_episode_is_left_out_of_results_and_statistics(tmp_path, host):
+    root = tmp_path / 'results'
+    for seed in range(6):
+        write_episode(root, f"episode{seed}", seed, extra=" zebra" if seed == 0 else "")
+    summary_index = SummaryIndex(str(tmp_path / 'index'), host=host)
+    summary_index.update(str(root))
+    count = summary_index.meta['count']
+
+    write_episode(root, 'episode0', 100, extra=" unicorn")
+    summary_index.update(str(root))
+    assert summary_index.meta['count'] > count
+    assert summary_index.search('zebra', alpha=0.0) == []
+    assert len(summary_index.search('unicorn', alpha=0.0)) == 1
+
+    # The statistics (and so the scores) are those of an index that never saw the old rows
+    fresh = fresh_index(tmp_path, root, host)
+    assert summary_index.meta['live_count'] == fresh.meta['live_count']
+    assert summary_index.meta['live_length'] == fresh.meta['live_length']
+    query = ' '.join(WORDS[:8])
+    assert results(summary_index, query) == results(fresh, query)
+
+def test_compaction_drops_deleted_rows(tmp_path, host):
+    root = tmp_path / 'results'
+    for seed in range(4):
+        write_episode(root, f"episode{seed}", seed)
+    summary_index = SummaryIndex(str(tmp_path / 'index'), host=host)
+    summary_index.update(str(root))
+    live_count = summary_index.meta['count']
+
+    for seed in range(10, 20):
+        write_episode(root, 'episode1', seed)
+        summary_index.update(str(root))
+        deleted = summary_index._deleted_mask()
+        assert deleted.sum() <= COMPACT_DELETED_FRACTION * len(deleted)
+    assert summary_index.meta['generation'] > 0
+    assert summary_index.meta['count'] < 2 * live_count
+    files = os.listdir(tmp_path / 'index')
+    assert not [name for name in files if name.startswith('g') and not name.startswith(f"g{summary_index.meta['generation']}.")]
+    segment_files = {name.split('.')[0] for name in files if name.startswith('segment_')}
+    assert segment_files == {segment['name'] for segment in summary_index.meta['segments']}
+
+    query = ' '.join(WORDS[10:20])
+    assert results(summary_index, query) == results(fresh_index(tmp_path, root, host), query)
+    assert_embeddings_line_up(summary_index)
+
+def test_interrupted_update_is_ignored_then_repaired(tmp_path, host):
+    root = tmp_path / 'results'
+    for seed in range(3):
+        write_episode(root, f"episode{seed}", seed)
+    index_dir = tmp_path / 'index'
+    summary_index = SummaryIndex(str(index_dir), host=host)
+    summary_index.update(str(root))
+    query = ' '.join(WORDS[:8])
+    expected = results(summary_index, query)
+    count, dim = summary_index.meta['count'], summary_index.meta['dim']
+
+    # What an update killed before its commit leaves behind
+    with open(summary_index._data_path('embeddings.f16'), 'ab') as f:
+        f.write(np.ones((7, dim), dtype=np.float16).tobytes())
+    with open(summary_index._data_path('lengths.i32'), 'ab') as f:
+        f.write(np.ones(7, dtype=np.int32).tobytes())
+    with open(summary_index._data_path('passages.jsonl'), 'ab') as f:
+        f.write(b'"partial')
+    (index_dir / 'segment_999999.terms.npy').write_bytes(b'partial')
+    (index_dir / 'g7.lengths.i32').write_bytes(b'partial')
+
+    assert results(SummaryIndex(str(index_dir), host=host), query) == expected
+    assert_embeddings_line_up(SummaryIndex(str(index_dir), host=host))
+
+    write_episode(root, 'episode3', 3)
+    summary_index = SummaryIndex(str(index_dir), host=host)
+    summary_index.update(str(root))
+    assert os.path.getsize(summary_index._data_path('embeddings.f16')) == summary_index.meta['count'] * dim * 2
+    assert os.path.getsize(summary_index._data_path('lengths.i32')) == summary_index.meta['count'] * 4
+    assert not (index_dir / 'segment_999999.terms.npy').exists()
+    assert not (index_dir / 'g7.lengths.i32').exists()
+    assert summary_index.meta['count'] > count
+    assert_embeddings_line_up(summary_index)
+    assert results(summary_index, query) == results(fresh_index(tmp_path, root, host), query)
+
+def test_episodes_added_one_at_a_time_merge_segments(tmp_path, host):
+    root = tmp_path / 'results'
+    summary_index = SummaryIndex(str(tmp_path / 'index'), host=host)
+    for seed in range(16):
+        summary_index.add_episode(write_episode(root, f"episode{seed}", seed))
+    assert len(summary_index.meta['segments']) <= 5
+    query = ' '.join(WORDS[30:40])
+    assert results(summary_index, query, k=10) == results(fresh_index(tmp_path, root, host), query, k=10)
+
+def _update(index_dir, root, host):
+    SummaryIndex(index_dir, host=host).update(root)
+
+def test_concurrent_updates_are_serialised(tmp_path, host):
+    index_dir = str(tmp_path / 'index')
+    roots = [tmp_path / 'first', tmp_path / 'second']
+    for root_index, root in enumerate(roots):
+        for seed in range(3):
+            write_episode(root, f"episode{root_index}_{seed}", seed + 10 * root_index)
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_update, args=(index_dir, str(root), host)) for root in roots * 2]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    summary_index = SummaryIndex(index_dir, host=host)
+    assert summary_index.meta['episodes'] == 6
+    assert summary_index.meta['live_count'] == summary_index.meta['count']
+    assert_embeddings_line_up(summary_index)